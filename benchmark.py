@@ -0,0 +1,581 @@
+"""Офлайн-бенчмарк резервного копирования без настоящих токенов.
+Поднимает в отдельном процессе локальные заглушки VK API, Instagram Graph API, CDN с фото,
+Яндекс Диска и Google Drive с настраиваемыми задержкой, пропускной способностью, долей ошибок
+и размерами альбомов, прогоняет через них настоящие классы загрузки из main.py и печатает
+фото/с, Мб/с, пиковый RSS и число обращений к API на одно фото.
+
+Пример: python benchmark.py --source vk --target both --albums 5 --photos 100 --latency 20 --bandwidth 20
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlsplit
+
+import main
+
+BLOCK_SIZE = 64 * 1024
+SHARED_FOLDER_ID = 'shared'
+
+
+class MockState:
+    """Состояние заглушек: настройки сценария, счетчики запросов по маршрутам,
+    папки и размеры файлов на Яндекс Диске и Google Drive, открытые сессии загрузки Drive.
+    """
+
+    def __init__(self, config):
+        """Конструктор класса MockState.
+        Примет словарь настроек сценария (см. parse_arguments).
+        """
+        self.config = config
+        self.lock = threading.Lock()
+        self.ids = count(1)
+        self.counters = {}
+        self.yandex_folders = set()
+        self.yandex_files = {}
+        self.drive_files = {SHARED_FOLDER_ID: {'id': SHARED_FOLDER_ID, 'name': 'Backup', 'parents': [],
+                                               'mimeType': main.GoogleDriveUploader.FOLDER_MIME_TYPE}}
+        self.drive_sessions = {}
+        self.random = random.Random(config['seed'])
+
+    def count(self, route):
+        """Учтет запрос к маршруту route."""
+        with self.lock:
+            self.counters[route] = self.counters.get(route, 0) + 1
+
+    def newId(self, prefix):
+        """Возвратит новый ID файла или сессии."""
+        with self.lock:
+            return f"{prefix}{next(self.ids)}"
+
+    def failNow(self):
+        """Решит, ответить ли на этот запрос ошибкой, с вероятностью error_rate."""
+        with self.lock:
+            return self.random.random() < self.config['error_rate']
+
+    def albumSize(self, album_id):
+        """Возвратит число фото в альбоме album_id."""
+        return self.config['photos']
+
+    def photoUrl(self, base, album_id, index):
+        """Возвратит ссылку на фото index альбома album_id на заглушке CDN."""
+        return f"{base}/cdn/{album_id}/{index}.jpg?sig={index}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов всех заглушек; маршрут определяется по пути запроса."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def base(self):
+        return f"http://{self.headers['Host']}"
+
+    def throttle(self, nbytes):
+        """Подождет, сколько заняла бы передача nbytes байт при заданной пропускной способности."""
+        if self.state.config['bandwidth']:
+            time.sleep(nbytes / self.state.config['bandwidth'])
+
+    def readBody(self):
+        """Прочитает тело запроса (обычное или chunked) с ограничением скорости и возвратит его."""
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(parts)
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+                self.throttle(size)
+        length = int(self.headers.get('Content-Length') or 0)
+        parts = []
+        while length > 0:
+            part = self.rfile.read(min(BLOCK_SIZE, length))
+            if not part:
+                break
+            parts.append(part)
+            length -= len(part)
+            self.throttle(len(part))
+        return b''.join(parts)
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        """Отправит ответ; dict и list сериализуются в JSON, тело отдается блоками с ограничением скорости."""
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        for start in range(0, len(body), BLOCK_SIZE):
+            self.wfile.write(body[start:start + BLOCK_SIZE])
+            self.throttle(min(BLOCK_SIZE, len(body) - start))
+
+    def handle_request(self, method):
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        body = self.readBody()
+        if parts.path == '/__stats':
+            return self.reply(200, self.state.counters)
+        time.sleep(self.state.config['latency'])
+        for prefix, handler in (('/method/', self.vk), ('/graph/', self.graph), ('/cdn/', self.cdn),
+                                ('/v1/disk', self.yandex), ('/yupload', self.yandexUpload),
+                                ('/drive/', self.drive), ('/upload/drive/', self.driveUpload),
+                                ('/batch/drive/', self.driveBatch)):
+            if parts.path.startswith(prefix):
+                return handler(method, parts.path, query, body)
+        self.reply(404, {})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    # VK API
+
+    def vkPhoto(self, album_id, index):
+        """Возвратит обьект фото VK с тремя размерами, последний - самый большой."""
+        url = self.state.photoUrl(self.base, album_id, index)
+        return {'id': index, 'owner_id': 1, 'album_id': album_id, 'date': 1600000000 + index,
+                'likes': {'count': index},
+                'sizes': [{'type': size_type, 'width': width, 'height': width * 3 // 4, 'url': f"{url}&t={size_type}"}
+                          for size_type, width in (('s', 75), ('x', 604), ('z', 1280))]}
+
+    def vkCall(self, method, params):
+        """Выполнит метод VK API и возвратит значение 'response'."""
+        if method == 'users.get':
+            return [{'id': 1, 'first_name': 'Bench', 'last_name': 'User'}]
+        if method == 'photos.getAlbums':
+            albums = [{'id': 1000 + i, 'title': f"album {i}", 'size': self.state.albumSize(1000 + i)}
+                      for i in range(self.state.config['albums'])]
+            offset, limit = int(params.get('offset', 0)), int(params.get('count', 100))
+            return {'count': len(albums), 'items': albums[offset:offset + limit]}
+        if method == 'photos.get':
+            album_id = params['album_id']
+            total = self.state.albumSize(album_id)
+            offset, limit = int(params.get('offset', 0)), int(params.get('count', 50))
+            return {'count': total, 'items': [self.vkPhoto(album_id, index)
+                                              for index in range(offset, min(total, offset + limit))]}
+        return None
+
+    def vk(self, method, path, query, body):
+        name = path[len('/method/'):]
+        self.state.count(f"vk:{name}")
+        if self.state.failNow():
+            return self.reply(200, {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}})
+        if method == 'POST':
+            query.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+        if name == 'execute':
+            calls = re.findall(r'API\.([\w.]+)\((\{[^{}]*\})\)', query['code'])
+            return self.reply(200, {'response': [self.vkCall(call, json.loads(params)) for call, params in calls]})
+        return self.reply(200, {'response': self.vkCall(name, query)})
+
+    # Instagram Graph API
+
+    def graph(self, method, path, query, body):
+        self.state.count('graph')
+        if self.state.failNow():
+            return self.reply(503, {'error': {'message': 'Service unavailable'}})
+        if path.endswith('/me/accounts'):
+            return self.reply(200, {'data': [{'id': 'page'}]})
+        if path.rstrip('/').endswith('/page'):
+            return self.reply(200, {'instagram_business_account': {'id': 'account'}, 'id': 'page'})
+        fields = query.get('fields', '')
+        total = self.state.config['albums'] * self.state.config['photos']
+        if 'media_count' in fields:
+            return self.reply(200, {'business_discovery': {'media_count': total,
+                                                           'profile_picture_url': f"{self.base}/cdn/profile/0.jpg"}})
+        page = re.search(r'media(?:\.after\(([^)]*)\))?\.limit\((\d+)\)', fields)
+        if page is None:
+            return self.reply(200, {'business_discovery': {'id': 'target'}})
+        offset, limit = int(page.group(1) or 0), int(page.group(2))
+        data = [{'id': str(index), 'media_type': 'IMAGE', 'timestamp': f"2021-01-01T00:00:{index % 60:02d}",
+                 'like_count': index, 'media_url': self.state.photoUrl(self.base, 'media', index)}
+                for index in range(offset, min(total, offset + limit))]
+        media = {'data': data}
+        if offset + limit < total:
+            media['paging'] = {'cursors': {'after': str(offset + limit)}}
+        return self.reply(200, {'business_discovery': {'media': media}})
+
+    # CDN
+
+    def cdn(self, method, path, query, body):
+        self.state.count('cdn')
+        if self.state.failNow():
+            return self.reply(503, b'', 'text/plain')
+        index = int(path.rsplit('/', 1)[1].split('.')[0])
+        data = bytes([index % 256]) * self.state.config['photo_size']
+        return self.reply(200, data, 'image/jpeg', {'ETag': f'"{index}"'})
+
+    # Яндекс Диск
+
+    def yandex(self, method, path, query, body):
+        self.state.count('yandex:api')
+        if method == 'GET' and self.state.failNow():
+            return self.reply(503, {'error': 'ServiceUnavailable'})
+        if path == '/v1/disk':
+            return self.reply(200, {'user': {'display_name': 'bench'}})
+        if path == '/v1/disk/resources/upload' and method == 'GET':
+            return self.reply(200, {'href': f"{self.base}/yupload?path={query['path']}", 'method': 'PUT'})
+        if path == '/v1/disk/resources/upload' and method == 'POST':
+            self.state.count('yandex:remote')
+            if query['path'] in self.state.yandex_files:
+                return self.reply(409, {'error': 'DiskResourceAlreadyExistsError'})
+            self.state.yandex_files[query['path']] = self.state.config['photo_size']
+            return self.reply(202, {'href': f"{self.base}/v1/disk/operations/{self.state.newId('op')}"})
+        if path.startswith('/v1/disk/operations/'):
+            return self.reply(200, {'status': 'success'})
+        if path == '/v1/disk/resources/copy':
+            self.state.yandex_files[query['path']] = self.state.yandex_files.get(query['from'], 0)
+            return self.reply(201, {})
+        if path == '/v1/disk/resources':
+            if method == 'GET':
+                exists = query['path'] in self.state.yandex_folders or query['path'] in self.state.yandex_files
+                return self.reply(200 if exists else 404, {})
+            if method == 'PUT':
+                if query['path'] in self.state.yandex_folders:
+                    return self.reply(409, {'error': 'DiskPathPointsToExistentDirectoryError'})
+                self.state.yandex_folders.add(query['path'])
+                return self.reply(201, {})
+        return self.reply(404, {})
+
+    def yandexUpload(self, method, path, query, body):
+        self.state.count('yandex:upload')
+        self.state.yandex_files[query['path']] = len(body)
+        return self.reply(201, b'', 'text/plain')
+
+    # Google Drive
+
+    def driveMatches(self, file, query):
+        """Проверит, подходит ли файл Drive под запрос q из files.list."""
+        for condition in re.split(r'\s+and\s+', query):
+            condition = condition.strip()
+            if condition.startswith('sharedWithMe'):
+                return file['id'] == SHARED_FOLDER_ID
+            name = re.match(r"name\s*=\s*'((?:[^'\\]|\\.)*)'", condition)
+            if name and file['name'] != re.sub(r"\\(.)", r"\1", name.group(1)):
+                return False
+            parent = re.match(r"'([^']*)'\s+in parents", condition)
+            if parent and parent.group(1) not in file['parents']:
+                return False
+            mime_type = re.match(r"mimeType\s*=\s*'([^']*)'", condition)
+            if mime_type and file['mimeType'] != mime_type.group(1):
+                return False
+        return True
+
+    def driveCreate(self, metadata):
+        """Создаст файл или папку Drive без содержимого и возвратит ее описание."""
+        file_id = self.state.newId('f')
+        self.state.drive_files[file_id] = {'id': file_id, 'name': metadata['name'],
+                                           'mimeType': metadata.get('mimeType', 'image/jpeg'),
+                                           'parents': metadata.get('parents', []), 'size': 0}
+        return {'id': file_id}
+
+    def drive(self, method, path, query, body):
+        self.state.count('drive:api')
+        if method == 'GET' and self.state.failNow():
+            return self.reply(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+        if method == 'GET' and path == '/drive/v3/files':
+            files = [file for file in self.state.drive_files.values() if self.driveMatches(file, query.get('q', ''))]
+            start, size = int(query.get('pageToken') or 0), int(query.get('pageSize') or 100)
+            result = {'files': [dict(file, permissions=[{'role': 'owner', 'emailAddress': 'bench@example.com'}])
+                                for file in files[start:start + size]]}
+            if start + size < len(files):
+                result['nextPageToken'] = str(start + size)
+            return self.reply(200, result)
+        if method == 'POST' and path == '/drive/v3/files':
+            return self.reply(200, self.driveCreate(json.loads(body)))
+        if method == 'POST' and path.endswith('/copy'):
+            source = self.state.drive_files.get(path.split('/')[-2])
+            if source is None:
+                return self.reply(404, {'error': {'code': 404, 'message': 'File not found'}})
+            return self.reply(200, self.driveCreate(dict(source, **json.loads(body or b'{}'))))
+        if method == 'DELETE':
+            self.state.drive_files.pop(path.rsplit('/', 1)[1], None)
+            return self.reply(204, b'')
+        return self.reply(404, {})
+
+    def driveUpload(self, method, path, query, body):
+        self.state.count('drive:upload')
+        if method in ('POST', 'PATCH'):
+            session_id = self.state.newId('s')
+            file_id = path.rsplit('/', 1)[1] if method == 'PATCH' else None
+            self.state.drive_sessions[session_id] = {'metadata': json.loads(body or b'{}'), 'size': 0,
+                                                     'file_id': file_id}
+            location = f"{self.base}/upload/drive/v3/files?upload_id={session_id}"
+            return self.reply(200, {}, headers={'Location': location})
+        session = self.state.drive_sessions.get(query.get('upload_id'))
+        if session is None:
+            return self.reply(404, {})
+        content_range = re.match(r'bytes (\d+)-(\d+)/(\*|\d+)', self.headers.get('Content-Range', ''))
+        total = None
+        if content_range:
+            session['size'] = int(content_range.group(2)) + 1
+            total = content_range.group(3)
+        elif self.headers.get('Content-Range', '').endswith('/*'):
+            total = '*'
+        else:
+            total = str(session['size'] + len(body))
+            session['size'] += len(body)
+        if total != '*' and int(total) == session['size']:
+            file_id = session['file_id'] or self.driveCreate(session['metadata'])['id']
+            self.state.drive_files[file_id]['size'] = session['size']
+            return self.reply(200, {'id': file_id})
+        headers = {'Range': f"bytes=0-{session['size'] - 1}"} if session['size'] else {}
+        return self.reply(308, b'', 'text/plain', headers)
+
+    def driveBatch(self, method, path, query, body):
+        self.state.count('drive:batch')
+        boundary = self.headers['Content-Type'].split('boundary=')[1].strip('"')
+        answers = []
+        for part in body.split(f"--{boundary}".encode())[1:-1]:
+            part = part.replace(b'\r\n', b'\n')
+            head, _, inner = part.strip(b'\n').partition(b'\n\n')
+            content_id = re.search(rb'Content-ID: <(.*)>', head).group(1).decode()
+            request_line, _, rest = inner.partition(b'\n')
+            inner_method, inner_path, _ = request_line.decode().split(' ')
+            _, _, inner_body = rest.partition(b'\n\n')
+            status, result = 404, {}
+            if inner_method == 'POST' and urlsplit(inner_path).path.endswith('/files'):
+                status, result = 200, self.driveCreate(json.loads(inner_body))
+            elif inner_method == 'DELETE':
+                self.state.drive_files.pop(urlsplit(inner_path).path.rsplit('/', 1)[1], None)
+                status, result = 204, None
+            content = b'' if result is None else json.dumps(result).encode()
+            answers.append(f"--batch\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                           f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                           f"Content-Length: {len(content)}\r\n\r\n".encode() + content + b"\r\n")
+        self.reply(200, b''.join(answers) + b'--batch--\r\n', 'multipart/mixed; boundary=batch')
+
+
+def serve(config, ports):
+    """Запустит заглушки в текущем процессе и сообщит порт через очередь ports."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(config)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock(config):
+    """Запустит заглушки в отдельном процессе, чтобы их память не попадала в замер RSS.
+    Возвратит процесс и базовый адрес заглушек.
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(config, ports), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get(timeout=10)}"
+
+
+def drive_service(base, credentials):
+    """Возвратит обьект Drive API, направленный на заглушку base, из встроенного описания API."""
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    document = json.loads(get_static_doc('drive', 'v3'))
+    document['rootUrl'] = f"{base}/"
+    document['baseUrl'] = f"{base}/drive/v3/"
+    return build_from_document(document, credentials=credentials)
+
+
+def create_uploader(target, base, state, workers, remote_fetch=False):
+    """Создаст настоящий загрузчик target ('yandex', 'gdrive' или 'both'), направленный на заглушки,
+    или загрузчик в локальную папку ('local') или архив ('archive') в текущей папке.
+    remote_fetch включает для Яндекс Диска загрузку по ссылке (кроме 'both').
+    """
+    download_workers, upload_workers, queue_size = workers
+
+    class BenchYandexUploader(main.YandexUploader):
+        url = f"{base}/v1/disk"
+
+    def yandex(remote=False):
+        return BenchYandexUploader('token', download_workers, upload_workers, queue_size, state=state,
+                                   remote_fetch=remote)
+
+    def gdrive():
+        from google.auth.credentials import AnonymousCredentials
+        credentials = AnonymousCredentials()
+        return main.GoogleDriveUploader(None, download_workers, upload_workers, queue_size, state=state,
+                                        credentials=credentials, service=drive_service(base, credentials))
+
+    if target == 'yandex':
+        return yandex(remote_fetch)
+    if target == 'gdrive':
+        return gdrive()
+    if target == 'local':
+        return main.LocalDirectoryUploader('backup', download_workers, upload_workers, queue_size, state=state)
+    if target == 'archive':
+        return main.ArchiveUploader('backup.tar', download_workers, upload_workers, queue_size, state=state)
+    return main.MultiUploader([yandex(), gdrive()], download_workers, upload_workers, queue_size)
+
+
+def run_source(source, uploader, base, album_workers):
+    """Прогонит резервное копирование аккаунта-заглушки source ('vk' или 'instagram') через uploader.
+    Возвратит число загруженных фото.
+    """
+    if source == 'vk':
+        class BenchVkUser(main.VkUser):
+            url = f"{base}/method/"
+
+        media = BenchVkUser('token', '5.130', '1')
+        jobs, _ = main.vk_upload_albums(uploader, media, album_workers=album_workers, ask=main.take_all)
+        return sum(job.get('uploaded', 0) for job in jobs)
+
+    class BenchInstaUser(main.InstaUser):
+        graph_url = f"{base}/graph/"
+
+    media = BenchInstaUser('token', 'v10.0', 'bench')
+    return main.ig_upload_all_photos(uploader, media, ask=main.take_all)['uploaded'] + 1
+
+
+def fetch_counters(base):
+    """Возвратит счетчики запросов заглушек по маршрутам."""
+    return main.http_sessions.get('cdn').get(f"{base}/__stats").json()
+
+
+def run_benchmark(config):
+    """Выполнит один прогон сценария config и возвратит словарь с результатами."""
+    process, base = start_mock(config)
+    work_dir = tempfile.mkdtemp(prefix='backup-bench-')
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        main.metrics.reset()
+        main.metrics.enabled = True
+        state = main.BackupState(os.path.join(work_dir, 'state.db'))
+        uploader = create_uploader(config['target'], base, state,
+                                   (config['download_workers'], config['upload_workers'], config['queue_size']),
+                                   config['remote_fetch'])
+        started = time.perf_counter()
+        photos = run_source(config['source'], uploader, base, config['album_workers'])
+        if isinstance(uploader, main.ArchiveUploader):
+            uploader.close()
+        elapsed = time.perf_counter() - started
+        counters = fetch_counters(base)
+    finally:
+        os.chdir(previous_dir)
+        process.terminate()
+    transfers = (counters.get('cdn', 0) + counters.get('yandex:upload', 0) + counters.get('drive:upload', 0)
+                 + counters.get('yandex:remote', 0))
+    api_calls = sum(counters.values()) - transfers
+    uploaded_bytes = main.metrics.report()['stages'].get('upload', {}).get('bytes', 0)
+    return {'photos': photos,
+            'seconds': round(elapsed, 3),
+            'photos_per_second': round(photos / elapsed, 2) if elapsed else 0,
+            'mb_per_second': round(uploaded_bytes / elapsed / 1024 / 1024, 2) if elapsed else 0,
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'api_calls': api_calls,
+            'api_calls_per_photo': round(api_calls / photos, 3) if photos else 0,
+            'requests': counters}
+
+
+def parse_arguments(argv=None):
+    """Разберет аргументы командной строки и возвратит словарь настроек сценария и параметры запуска."""
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк загрузки фото через локальные заглушки API')
+    parser.add_argument('--source', choices=('vk', 'instagram'), default='vk')
+    parser.add_argument('--target', choices=('yandex', 'gdrive', 'both', 'local', 'archive'),
+                        default='yandex')
+    parser.add_argument('--albums', type=int, default=3,
+                        help='число альбомов VK (кроме profile и wall); для Instagram медиа = albums * photos')
+    parser.add_argument('--photos', type=int, default=50, help='фото в каждом альбоме')
+    parser.add_argument('--photo-kb', type=int, default=256, help='размер одного фото, Кб')
+    parser.add_argument('--latency', type=float, default=10, help='задержка ответа заглушек, мс')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='пропускная способность одного соединения, Мб/с (0 - без ограничения)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='доля ответов с ошибкой для запросов к API и CDN (загрузки данных не ломаются)')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--album-workers', type=int, default=3)
+    parser.add_argument('--remote-fetch', action='store_true',
+                        help='Яндекс Диск сам скачивает фото по ссылкам (remote_fetch)')
+    parser.add_argument('--repeat', type=int, default=1, help='число прогонов')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора ошибок')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    arguments = parser.parse_args(argv)
+    config = {'source': arguments.source, 'target': arguments.target, 'albums': arguments.albums,
+              'photos': arguments.photos, 'photo_size': arguments.photo_kb * 1024,
+              'latency': arguments.latency / 1000, 'bandwidth': arguments.bandwidth * 1024 * 1024,
+              'error_rate': arguments.error_rate, 'download_workers': arguments.download_workers,
+              'upload_workers': arguments.upload_workers, 'queue_size': arguments.queue_size,
+              'album_workers': arguments.album_workers, 'remote_fetch': arguments.remote_fetch,
+              'seed': arguments.seed}
+    return config, arguments
+
+
+def run_child(config, results):
+    """Выполнит прогон run_benchmark в дочернем процессе и передаст результат (или текст ошибки) в results."""
+    try:
+        results.put(run_benchmark(config))
+    except BaseException as error:
+        results.put({'error': repr(error)})
+        raise
+
+
+def run_isolated(config):
+    """Выполнит прогон run_benchmark в отдельном процессе и возвратит словарь с результатами.
+    ru_maxrss считается на весь процесс, поэтому иначе пиковый RSS каждого прогона --repeat
+    был бы не меньше пика всех предыдущих.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_child, args=(config, results))
+    process.start()
+    try:
+        while process.is_alive() or not results.empty():
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            raise RuntimeError(f"Прогон завершился с кодом {process.exitcode}")
+    finally:
+        process.join()
+    if 'error' in result:
+        raise RuntimeError(f"Прогон завершился с ошибкой: {result['error']}")
+    return result
+
+
+def main_benchmark(argv=None):
+    config, arguments = parse_arguments(argv)
+    runs = []
+    for _ in range(max(1, arguments.repeat)):
+        runs.append(run_isolated(config))
+    for number, run in enumerate(runs, 1):
+        print(f"Прогон {number}: {run['photos']} фото за {run['seconds']} с, {run['photos_per_second']} фото/с, "
+              f"{run['mb_per_second']} Мб/с, пиковый RSS {run['peak_rss_mb']} Мб, "
+              f"запросов к API на фото {run['api_calls_per_photo']}")
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as file:
+            json.dump({'config': config, 'runs': runs}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -1,34 +1,1523 @@
-from tqdm.auto import tqdm
 import os
+import argparse
+import atexit
+import hashlib
+import io
 import json
-from googleapiclient.http import MediaIoBaseUpload
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from io import BytesIO
+import queue
+import random
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
+from itertools import chain, count, islice
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
+# Клиент Google API, numpy, Pillow и PyYAML нужны не каждому запуску и импортируются долго,
+# поэтому загружаются при первом обращении (load_google_api, load_imaging, load_job_file).
+MediaUpload = build_http = build = build_from_document = get_static_doc = HttpError = None
+service_account = AuthorizedHttp = StreamingMediaUpload = None
+np = Image = None
+
+CHUNK_SIZE = 1024 * 1024
+STATE_FILE = 'backup_state.db'
+CACHE_DIR = '.media_cache'
+CACHE_BYTES = 1024 ** 3
+GOOGLE_CACHE_DIR = '.gdrive_cache'
+SPOOL_MEMORY = CHUNK_SIZE
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: не больше rate запросов в секунду с запасом burst."""
+
+    def __init__(self, rate, burst=1):
+        """Конструктор класса TokenBucket.
+        Примет допустимое число запросов в секунду и размер запаса.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Заберет один токен, при необходимости подождав его появления."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RequestScheduler:
+    """Планировщик запросов: ограничение частоты по хостам и повторы с экспоненциальной паузой и джиттером."""
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, limits=None, max_retries=5, backoff_base=0.5, backoff_max=60):
+        """Конструктор класса RequestScheduler.
+        Примет словарь {хост: запросов в секунду}, число повторов, начальную и максимальную паузы.
+        """
+        self.buckets = {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        for host, rate in (limits or {}).items():
+            self.setLimit(host, rate)
+
+    def setLimit(self, host, rate):
+        """Задаст ограничение rate запросов в секунду для хоста host (None - без ограничения)."""
+        if rate is None:
+            self.buckets.pop(host, None)
+        else:
+            self.buckets[host] = TokenBucket(rate)
+
+    def acquire(self, host):
+        """Дождется разрешения на запрос к хосту host."""
+        bucket = self.buckets.get(host)
+        if bucket is not None:
+            bucket.acquire()
+
+    def backoffDelay(self, attempt, retry_after=None):
+        """Возвратит паузу перед повтором номер attempt: значение Retry-After, если оно задано,
+        иначе случайную паузу до backoff_base * 2 ** attempt (не больше backoff_max).
+        """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                try:
+                    return min(max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()),
+                               self.backoff_max)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def wait(self, attempt, retry_after=None):
+        """Подождет перед повтором номер attempt."""
+        time.sleep(self.backoffDelay(attempt, retry_after))
+
+
+scheduler = RequestScheduler({'api.vk.com': 3})
+
+
+def endpoint_name(method, url, collapse_path=False):
+    """Возвратит имя конечной точки для метрик: метод, хост и путь, в котором ID заменены на {id}.
+    При collapse_path путь отбрасывается (например, для CDN, где у каждого фото свой путь).
+    """
+    parts = urlsplit(url)
+    if collapse_path:
+        return f"{method} {parts.hostname}"
+    segments = ['{id}' if len(segment) >= 24 or sum(char.isdigit() for char in segment) >= 4 else segment
+                for segment in parts.path.split('/')]
+    return f"{method} {parts.hostname}{'/'.join(segments)}"
+
+
+class Metrics:
+    """Сборщик метрик запуска: по каждой конечной точке число запросов и ответов по кодам, повторы,
+    гистограмма задержек и переданные байты, а по этапам конвейера - число элементов, время и байты.
+    Выключен по умолчанию: тогда каждая точка замера обходится одной проверкой флага enabled.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, enabled=False):
+        """Конструктор класса Metrics.
+        Примет признак включения сбора метрик.
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Обнулит собранные метрики и начнет отсчет времени заново, не меняя признак enabled."""
+        with self.lock:
+            self.started = time.time()
+            self.endpoints = {}
+            self.stages = {}
+
+    def endpoint(self, name):
+        """Возвратит словарь счетчиков конечной точки name, создав его при первом обращении."""
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = {'requests': 0, 'errors': 0, 'retries': 0, 'statuses': {},
+                                            'bytes_sent': 0, 'bytes_received': 0, 'seconds': 0.0, 'max': 0.0,
+                                            'buckets': [0] * (len(self.buckets) + 1)}
+        return stats
+
+    def observe(self, name, seconds, status=None, bytes_sent=0, bytes_received=0):
+        """Учтет один запрос к конечной точке name: длительность, код ответа (None - обрыв) и байты."""
+        bucket = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.lock:
+            stats = self.endpoint(name)
+            stats['requests'] += 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            if status in scheduler.retry_statuses:
+                stats['retries'] += 1
+            status_key = str(status)
+            stats['statuses'][status_key] = stats['statuses'].get(status_key, 0) + 1
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['buckets'][bucket] += 1
+
+    def retry(self, name):
+        """Учтет повтор запроса к конечной точке name, не видный по коду HTTP (например, ошибку VK API)."""
+        with self.lock:
+            self.endpoint(name)['retries'] += 1
+
+    def stage(self, name, seconds, items=1, nbytes=0):
+        """Учтет работу этапа name: время, число обработанных элементов и байт."""
+        with self.lock:
+            stats = self.stages.setdefault(name, {'items': 0, 'seconds': 0.0, 'bytes': 0})
+            stats['items'] += items
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+
+    def report(self):
+        """Возвратит отчет о запуске в виде словаря для JSON."""
+        with self.lock:
+            endpoints = {}
+            for name, stats in sorted(self.endpoints.items()):
+                endpoints[name] = {key: value for key, value in stats.items() if key != 'buckets'}
+                endpoints[name]['mean'] = stats['seconds'] / stats['requests'] if stats['requests'] else 0
+                endpoints[name]['latency_buckets'] = dict(zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                                              stats['buckets']))
+            stages = {}
+            for name, stats in sorted(self.stages.items()):
+                stages[name] = dict(stats, items_per_second=stats['items'] / stats['seconds'] if stats['seconds'] else 0,
+                                    bytes_per_second=stats['bytes'] / stats['seconds'] if stats['seconds'] else 0)
+        return {'started': self.started, 'elapsed': time.time() - self.started,
+                'endpoints': endpoints, 'stages': stages}
+
+    def prometheus(self):
+        """Возвратит метрики в текстовом формате Prometheus."""
+        families = {'backup_requests_total': ('counter', []),
+                    'backup_request_retries_total': ('counter', []),
+                    'backup_request_bytes_total': ('counter', []),
+                    'backup_request_duration_seconds': ('histogram', []),
+                    'backup_stage_items_total': ('counter', []),
+                    'backup_stage_seconds_total': ('counter', []),
+                    'backup_stage_bytes_total': ('counter', [])}
+        with self.lock:
+            for name, stats in sorted(self.endpoints.items()):
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                for status, number in sorted(stats['statuses'].items()):
+                    families['backup_requests_total'][1].append(
+                        f'backup_requests_total{{endpoint="{label}",status="{status}"}} {number}')
+                families['backup_request_retries_total'][1].append(
+                    f'backup_request_retries_total{{endpoint="{label}"}} {stats["retries"]}')
+                for direction in ('sent', 'received'):
+                    families['backup_request_bytes_total'][1].append(
+                        f'backup_request_bytes_total{{endpoint="{label}",direction="{direction}"}} '
+                        f'{stats["bytes_" + direction]}')
+                histogram = families['backup_request_duration_seconds'][1]
+                cumulative = 0
+                for bound, number in zip([str(bound) for bound in self.buckets] + ['+Inf'], stats['buckets']):
+                    cumulative += number
+                    histogram.append(f'backup_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} '
+                                     f'{cumulative}')
+                histogram.append(f'backup_request_duration_seconds_sum{{endpoint="{label}"}} {stats["seconds"]}')
+                histogram.append(f'backup_request_duration_seconds_count{{endpoint="{label}"}} {stats["requests"]}')
+            for name, stats in sorted(self.stages.items()):
+                for key in ('items', 'seconds', 'bytes'):
+                    families[f'backup_stage_{key}_total'][1].append(
+                        f'backup_stage_{key}_total{{stage="{name}"}} {stats[key]}')
+        lines = []
+        for family, (kind, samples) in families.items():
+            lines.append(f'# TYPE {family} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        """Запишет отчет в JSON-файл json_path и/или в текстовом формате Prometheus в prometheus_path."""
+        if json_path:
+            with open(json_path, 'w', encoding='utf-8') as file:
+                json.dump(self.report(), file, ensure_ascii=False, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w', encoding='utf-8') as file:
+                file.write(self.prometheus())
+
+
+metrics = Metrics()
+
+
+class MeteredHttp:
+    """Обертка http-клиента httplib2 (Google API), учитывающая каждый запрос в метриках."""
+
+    def __init__(self, http):
+        """Конструктор класса MeteredHttp.
+        Примет http-клиент с методом request(uri, method, body, headers, ...).
+        """
+        self.http = http
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        if not metrics.enabled:
+            return self.http.request(uri, method, body, headers, *args, **kwargs)
+        started = time.perf_counter()
+        status = None
+        try:
+            response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+            status = response.status
+            return response, content
+        finally:
+            metrics.observe(endpoint_name(method, uri), time.perf_counter() - started, status,
+                            len(body) if isinstance(body, (bytes, str)) else 0,
+                            len(content) if status is not None else 0)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """HTTPAdapter, который перед каждым запросом ждет разрешения планировщика по хосту
+    и повторяет запросы при обрывах соединения, 429 и 5xx с учетом Retry-After.
+    Запросы с потоковым телом повторить нельзя, для них ошибка возвращается сразу.
+    """
+
+    def __init__(self, request_scheduler, collapse_paths=False, **kwargs):
+        """Конструктор класса ScheduledAdapter.
+        Примет планировщик RequestScheduler, признак учета в метриках только хоста без пути
+        и параметры HTTPAdapter.
+        """
+        self.scheduler = request_scheduler
+        self.collapse_paths = collapse_paths
+        super().__init__(**kwargs)
+
+    def meteredSend(self, request, **kwargs):
+        """Отправит запрос и, если метрики включены, учтет его длительность, код ответа и байты."""
+        if not metrics.enabled:
+            return super().send(request, **kwargs)
+        name = endpoint_name(request.method, request.url, self.collapse_paths)
+        sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            metrics.observe(name, time.perf_counter() - started, None, sent)
+            raise
+        metrics.observe(name, time.perf_counter() - started, response.status_code, sent,
+                        int(response.headers.get('Content-Length') or 0))
+        return response
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).hostname
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        for attempt in count():
+            self.scheduler.acquire(host)
+            try:
+                response = self.meteredSend(request, **kwargs)
+            except (ConnectionError, Timeout):
+                if not replayable or attempt >= self.scheduler.max_retries:
+                    raise
+                self.scheduler.wait(attempt)
+                continue
+            if (response.status_code not in self.scheduler.retry_statuses or not replayable
+                    or attempt >= self.scheduler.max_retries):
+                return response
+            retry_after = response.headers.get('Retry-After')
+            response.close()
+            self.scheduler.wait(attempt, retry_after)
+
+
+class HttpSessions:
+    """Менеджер постоянных сессий requests: по одной сессии на каждый API-клиент и на скачивание фото.
+    Соединения остаются открытыми (keep-alive), поэтому TCP и TLS устанавливаются один раз на хост.
+    Все запросы сессий проходят через планировщик частоты и повторов.
+    """
+
+    def __init__(self, request_scheduler, pool_size=10, pool_hosts=16):
+        """Конструктор класса HttpSessions.
+        Примет планировщик запросов, размер пула соединений на хост и число хостов, для которых хранятся пулы.
+        """
+        self.scheduler = request_scheduler
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def mountAdapter(self, name, session):
+        """Подключит к сессии name HTTPAdapter с текущими размерами пулов.
+        Для сессии скачивания фото 'cdn' метрики ведутся по хостам, а не по путям.
+        """
+        adapter = ScheduledAdapter(self.scheduler, collapse_paths=name == 'cdn',
+                                   pool_connections=self.pool_hosts, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def get(self, name):
+        """Возвратит сессию с именем name, создав ее при первом обращении."""
+        with self.lock:
+            if name not in self.sessions:
+                session = requests.Session()
+                self.mountAdapter(name, session)
+                self.sessions[name] = session
+            return self.sessions[name]
+
+    def resize(self, pool_size):
+        """Увеличит пулы соединений до pool_size, чтобы их хватало всем параллельным потокам загрузки."""
+        with self.lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            for name, session in self.sessions.items():
+                self.mountAdapter(name, session)
+
+
+http_sessions = HttpSessions(scheduler)
+
+
+class TransferPipeline:
+    """Конвейер загрузки: потоки скачивания фото из источника и потоки отправки в облако,
+    связанные ограниченной очередью, чтобы одновременно было открыто не больше queue_size потоков сверх работающих.
+    Если задан общий бюджет (семафор budget), каждое фото занимает из него место от начала скачивания
+    до конца отправки: так несколько одновременно работающих конвейеров не превышают общий предел передач.
+    """
+    _end = object()
+
+    def __init__(self, download_workers=4, upload_workers=4, queue_size=8, budget=None):
+        """Конструктор класса TransferPipeline.
+        Примет число потоков скачивания, число потоков отправки, размер очереди между ними
+        и общий для нескольких конвейеров семафор одновременных передач.
+        """
+        self.download_workers = max(1, download_workers)
+        self.upload_workers = max(1, upload_workers)
+        self.queue_size = max(1, queue_size)
+        self.budget = budget
+        http_sessions.resize(self.download_workers + self.queue_size + self.upload_workers)
+
+    def acquire(self):
+        """Займет место в общем бюджете передач, если он задан."""
+        if self.budget is not None:
+            self.budget.acquire()
+
+    def release(self):
+        """Освободит место в общем бюджете передач, если он задан."""
+        if self.budget is not None:
+            self.budget.release()
+
+    def run(self, photos, download, upload, desc):
+        """Примет список фото, функцию скачивания download(photo) -> MediaStream,
+        функцию отправки upload(photo, stream) и подпись прогресс-бара.
+        Прогресс-бар считает реально переданные байты. Первая ошибка любого потока
+        останавливает конвейер и выбрасывается после завершения всех потоков.
+        """
+        photos_iter = iter(photos)
+        iter_lock = threading.Lock()
+        progress_lock = threading.Lock()
+        buffer = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def fail(error):
+            errors.append(error)
+            stop.set()
+
+        def advance(progress, nbytes):
+            with progress_lock:
+                progress.update(nbytes)
+
+        def download_worker():
+            try:
+                while not stop.is_set():
+                    self.acquire()
+                    try:
+                        with iter_lock:
+                            photo = next(photos_iter, self._end)
+                        if photo is self._end:
+                            self.release()
+                            return
+                        if metrics.enabled:
+                            started = time.perf_counter()
+                            item = (photo, download(photo))
+                            metrics.stage('download', time.perf_counter() - started)
+                        else:
+                            item = (photo, download(photo))
+                    except Exception:
+                        self.release()
+                        raise
+                    while not stop.is_set():
+                        try:
+                            buffer.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    else:
+                        item[1].close()
+                        self.release()
+            except Exception as error:
+                fail(error)
+
+        def upload_worker(progress):
+            while True:
+                item = buffer.get()
+                if item is self._end:
+                    return
+                photo, stream = item
+                try:
+                    if not stop.is_set():
+                        stream.callback = partial(advance, progress)
+                        if metrics.enabled:
+                            started = time.perf_counter()
+                            upload(photo, stream)
+                            metrics.stage('upload', time.perf_counter() - started, nbytes=stream.bytes_read)
+                        else:
+                            upload(photo, stream)
+                except Exception as error:
+                    fail(error)
+                finally:
+                    stream.close()
+                    self.release()
+
+        from tqdm.auto import tqdm
+        run_started = time.perf_counter()
+        with tqdm(ncols=100, desc=desc, unit='B', unit_scale=True, unit_divisor=1024) as progress:
+            downloaders = [threading.Thread(target=download_worker, daemon=True)
+                           for _ in range(self.download_workers)]
+            uploaders = [threading.Thread(target=upload_worker, args=(progress,), daemon=True)
+                         for _ in range(self.upload_workers)]
+            for worker in downloaders + uploaders:
+                worker.start()
+            for worker in downloaders:
+                worker.join()
+            for _ in uploaders:
+                buffer.put(self._end)
+            for worker in uploaders:
+                worker.join()
+            if metrics.enabled:
+                metrics.stage('pipeline', time.perf_counter() - run_started, 0, progress.n)
+        if errors:
+            raise errors[0]
+
+
+class MediaStream:
+    """Файлоподобный поток содержимого фото из источника.
+    Отдает данные кусками по chunk_size и считает прочитанные байты, не держа весь файл в памяти.
+    Если задан digest (обьект hashlib), попутно считает хеш прочитанного содержимого.
+    finished становится True, когда поток прочитан до конца.
+    """
+    digest = None
+    size = None
+    finished = False
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        """Конструктор класса MediaStream.
+        Примет ответ requests, открытый с stream=True, и размер куска.
+        """
+        self.response = response
+        self.etag = response.headers.get('ETag')
+        self.sha256 = None
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.callback = None
+        self._chunks = response.iter_content(chunk_size)
+        self._pending = b''
+
+    def read(self, size=-1):
+        """Возвратит до size следующих байт потока (все оставшиеся, если size < 0)."""
+        parts = [self._pending]
+        have = len(self._pending)
+        while size < 0 or have < size:
+            chunk = next(self._chunks, b'')
+            if not chunk:
+                self.finished = True
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        data = b''.join(parts)
+        if 0 <= size < len(data):
+            data, self._pending = data[:size], data[size:]
+        else:
+            self._pending = b''
+        self._consume(data)
+        return data
+
+    def _consume(self, data):
+        """Учтет выданные данные: счетчик байт, хеш и callback прогресса."""
+        self.bytes_read += len(data)
+        if self.digest is not None and data:
+            self.digest.update(data)
+        if self.callback is not None and data:
+            self.callback(len(data))
+
+    def __iter__(self):
+        return iter(partial(self.read, self.chunk_size), b'')
+
+    def writeTo(self, file):
+        """Запишет все оставшееся содержимое потока в открытый двоичный файл file.
+        Куски источника передаются в файл как есть, без склейки и нарезки, как при read.
+        """
+        pending, self._pending = self._pending, b''
+        for chunk in chain([pending], self._chunks):
+            if chunk:
+                file.write(chunk)
+                self._consume(chunk)
+        self.finished = True
+
+    def close(self):
+        """Закроет соединение с источником."""
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        self.response.close()
+
+
+class FileMediaStream(MediaStream):
+    """Поток MediaStream, читающий фото из локального файла (например, из кеша)."""
+
+    def __init__(self, path, etag=None, sha256=None, chunk_size=CHUNK_SIZE):
+        """Конструктор класса FileMediaStream.
+        Примет путь к файлу, ETag источника, SHA-256 содержимого (если известен) и размер куска.
+        """
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.etag = etag
+        self.sha256 = sha256
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.callback = None
+        self._chunks = iter(partial(self.file.read, chunk_size), b'')
+        self._pending = b''
+
+    def writeTo(self, file):
+        """Запишет оставшееся содержимое в двоичный файл file через os.sendfile: данные копирует ядро,
+        не читая их в память процесса. Если нужно считать хеш или sendfile недоступен, читает обычным путем.
+        """
+        if self.digest is not None or self._pending or not hasattr(os, 'sendfile'):
+            return super().writeTo(file)
+        file.flush()
+        start = offset = self.file.tell()
+        while offset < self.size:
+            try:
+                sent = os.sendfile(file.fileno(), self.file.fileno(), offset, self.size - offset)
+            except OSError:
+                if offset != start:
+                    raise
+                return super().writeTo(file)
+            if sent == 0:
+                break
+            offset += sent
+            self.bytes_read += sent
+            if self.callback is not None:
+                self.callback(sent)
+        self.file.seek(offset)
+        self.finished = offset >= self.size
+
+    def close(self):
+        self.file.close()
+
+
+class SpooledMediaStream(MediaStream):
+    """Поток MediaStream, заранее дочитанный из источника во временный файл с подсчетом SHA-256.
+    Нужен, чтобы знать хеш содержимого до загрузки: небольшие фото остаются в памяти,
+    крупнее max_memory - сбрасываются на диск.
+    """
+
+    def __init__(self, source, max_memory=SPOOL_MEMORY):
+        """Конструктор класса SpooledMediaStream.
+        Примет исходный поток MediaStream (он будет прочитан целиком и закрыт) и предел буфера в памяти.
+        """
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        digest = hashlib.sha256()
+        try:
+            for chunk in source:
+                digest.update(chunk)
+                self.file.write(chunk)
+        except Exception:
+            self.file.close()
+            raise
+        finally:
+            source.close()
+        self.size = self.file.tell()
+        self.file.seek(0)
+        self.etag = source.etag
+        self.sha256 = digest.hexdigest()
+        self.chunk_size = source.chunk_size
+        self.bytes_read = 0
+        self.callback = None
+        self._chunks = iter(partial(self.file.read, self.chunk_size), b'')
+        self._pending = b''
+
+    def close(self):
+        self.file.close()
+
+
+class TeeStream(MediaStream):
+    """Ветка потока MediaStream для одного из нескольких назначений.
+    Получает куски исходного потока через свою ограниченную очередь, поэтому источник читается один раз,
+    а в памяти на ветку держится не больше depth кусков.
+    """
+
+    def __init__(self, source, depth=4):
+        """Конструктор класса TeeStream.
+        Примет исходный поток MediaStream и глубину очереди кусков.
+        """
+        self.etag = source.etag
+        self.sha256 = source.sha256
+        self.size = source.size
+        self.chunk_size = source.chunk_size
+        self.bytes_read = 0
+        self.callback = None
+        self.closed = False
+        self.queue = queue.Queue(maxsize=depth)
+        self._chunks = self._receive()
+        self._pending = b''
+
+    def _receive(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def feed(self, item):
+        """Передаст ветке кусок данных, None (конец потока) или исключение источника.
+        Если ветка уже закрыта назначением, кусок отбрасывается.
+        """
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingMediaSource:
+    """Источник данных для возобновляемой загрузки Google Drive из MediaStream.
+    Размер файла заранее неизвестен: в памяти держится только текущий кусок и упреждающее чтение,
+    чтобы узнать конец файла до отправки последнего куска.
+    Используется как StreamingMediaUpload - наследник MediaUpload, который создает load_google_api.
+    """
+
+    def __init__(self, stream, mimetype='image/jpeg', chunksize=CHUNK_SIZE):
+        """Конструктор класса StreamingMediaSource.
+        Примет поток MediaStream, MIME-тип и размер куска (кратный 256 Кб).
+        """
+        super().__init__()
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = b''
+        self._buffer_begin = 0
+        self._next_begin = 0
+        self._size = None
+
+    def _fill(self, end):
+        """Дочитает поток, пока буфер не дойдет до смещения end или поток не закончится."""
+        parts = [self._buffer]
+        have = self._buffer_begin + len(self._buffer)
+        while self._size is None and have < end:
+            chunk = self._stream.read(end - have)
+            if not chunk:
+                self._size = have
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        self._buffer = b''.join(parts)
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        if self._size is None:
+            self._fill(self._next_begin + self._chunksize + 1)
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def seek(self, offset):
+        """Пропустит первые offset байт потока, уже загруженные в прерванной сессии.
+        Вызывается до чтения данных; пропущенные байты не держатся в памяти.
+        """
+        while self._size is None and self._buffer_begin < offset:
+            chunk = self._stream.read(min(self._chunksize, offset - self._buffer_begin))
+            if not chunk:
+                self._size = self._buffer_begin
+                break
+            self._buffer_begin += len(chunk)
+        self._next_begin = self._buffer_begin
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_begin:
+            raise ValueError(f"Смещение {begin} уже вычитано из потока")
+        self._fill(begin + length + 1)
+        self._buffer = self._buffer[begin - self._buffer_begin:]
+        self._buffer_begin = begin
+        data = self._buffer[:length]
+        self._next_begin = begin + len(data)
+        return data
+
+
+class BackupState:
+    """Локальное хранилище состояния резервного копирования в SQLite.
+    Помнит, какие фото уже загружены в каждую папку назначения, чтобы при следующих запусках
+    передавать только новые или изменившиеся файлы. Фото считается изменившимся, если у него
+    другая ссылка (без параметров подписи) или другое имя файла.
+    Также хранит индекс SHA-256 загруженного содержимого по назначениям для дедупликации,
+    перцептивные хеши фото для поиска почти одинаковых (NearDuplicateDetector)
+    и журнал незавершенных передач: статус фото ('pending', 'downloading', 'uploading'),
+    URI сессии возобновляемой загрузки и подтвержденное сервером смещение.
+    """
+
+    def __init__(self, path=STATE_FILE, resume=False):
+        """Конструктор класса BackupState.
+        Примет путь к файлу базы данных состояния и признак продолжения прерванных загрузок
+        по журналу (иначе незавершенные сессии начинаются заново).
+        """
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transfers ('
+                                    'destination TEXT, folder TEXT, photo_key TEXT, url_key TEXT, '
+                                    'file_name TEXT, etag TEXT, updated REAL, '
+                                    'PRIMARY KEY (destination, folder, photo_key))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS contents ('
+                                    'destination TEXT, sha256 TEXT, location TEXT, '
+                                    'PRIMARY KEY (destination, sha256))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS perceptual ('
+                                    'photo_key TEXT PRIMARY KEY, url_key TEXT, hashes TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                                    'destination TEXT, folder TEXT, photo_key TEXT, status TEXT, '
+                                    'session_uri TEXT, offset INTEGER, updated REAL, '
+                                    'PRIMARY KEY (destination, folder, photo_key))')
+
+    @staticmethod
+    def photoKey(photo):
+        """Возвратит ключ фото: ID в источнике и тип размера."""
+        return f"{photo.get('id', photo['url'])}:{photo['size']}"
+
+    @staticmethod
+    def urlKey(photo):
+        """Возвратит ссылку на фото без параметров запроса, которые меняются от запроса к запросу."""
+        url = urlsplit(photo['url'])
+        return f"{url.netloc}{url.path}"
+
+    def isDone(self, destination, folder, photo):
+        """Проверит, загружено ли это фото без изменений в папку folder назначения destination."""
+        with self.lock:
+            row = self.connection.execute('SELECT url_key, file_name FROM transfers '
+                                          'WHERE destination = ? AND folder = ? AND photo_key = ?',
+                                          (destination, folder, self.photoKey(photo))).fetchone()
+        return row is not None and row == (self.urlKey(photo), photo['file_name'])
+
+    def pending(self, destination, folder, photos):
+        """Генератор фото из photos, которых еще нет в папке folder назначения destination.
+        Выданные фото отмечаются в журнале как 'pending', если у них еще нет записи.
+        """
+        for photo in photos:
+            if not self.isDone(destination, folder, photo):
+                with self.lock, self.connection:
+                    self.connection.execute('INSERT OR IGNORE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            (destination, folder, self.photoKey(photo), 'pending', None, 0,
+                                             time.time()))
+                yield photo
+
+    def checkpoint(self, destination, folder, photo, status, session_uri=None, offset=0):
+        """Запишет в журнал статус передачи фото и, для возобновляемой загрузки, URI сессии и смещение."""
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (destination, folder, self.photoKey(photo), status, session_uri, offset,
+                                     time.time()))
+
+    def getCheckpoint(self, destination, folder, photo):
+        """Возвратит из журнала (статус, URI сессии, смещение) незавершенной передачи фото
+        или None, если записи нет или продолжение прерванных загрузок выключено.
+        """
+        if not self.resume:
+            return None
+        with self.lock:
+            return self.connection.execute('SELECT status, session_uri, offset FROM checkpoints '
+                                           'WHERE destination = ? AND folder = ? AND photo_key = ?',
+                                           (destination, folder, self.photoKey(photo))).fetchone()
+
+    def trackDownload(self, destination, folder, download, photo):
+        """Отметит в журнале начало скачивания фото и вызовет download(photo)."""
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE checkpoints SET status = ?, updated = ? '
+                                    'WHERE destination = ? AND folder = ? AND photo_key = ? AND status = ?',
+                                    ('downloading', time.time(), destination, folder, self.photoKey(photo),
+                                     'pending'))
+        return download(photo)
+
+    def markDone(self, destination, folder, photo, etag=None):
+        """Запишет, что фото загружено в папку folder назначения destination, и удалит его из журнала."""
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (destination, folder, self.photoKey(photo), self.urlKey(photo),
+                                     photo['file_name'], etag, time.time()))
+            self.connection.execute('DELETE FROM checkpoints WHERE destination = ? AND folder = ? AND photo_key = ?',
+                                    (destination, folder, self.photoKey(photo)))
+
+    def findContent(self, destination, sha256):
+        """Возвратит расположение уже загруженного в назначение destination файла с хешем sha256 или None."""
+        with self.lock:
+            row = self.connection.execute('SELECT location FROM contents WHERE destination = ? AND sha256 = ?',
+                                          (destination, sha256)).fetchone()
+        return None if row is None else row[0]
+
+    def addContent(self, destination, sha256, location):
+        """Запишет, что файл с хешем sha256 лежит в назначении destination по адресу location."""
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO contents VALUES (?, ?, ?)',
+                                    (destination, sha256, location))
+
+    def dropContent(self, destination, sha256):
+        """Забудет расположение файла с хешем sha256 в назначении destination (например, файл удален)."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM contents WHERE destination = ? AND sha256 = ?',
+                                    (destination, sha256))
+
+    def findHashes(self, photos):
+        """Возвратит словарь {индекс фото: перцептивные хеши или None} для фото из списка photos,
+        хеши которых уже сохранены и ссылка на которые с тех пор не изменилась.
+        """
+        found = {}
+        with self.lock:
+            for i, photo in enumerate(photos):
+                row = self.connection.execute('SELECT url_key, hashes FROM perceptual WHERE photo_key = ?',
+                                              (self.photoKey(photo),)).fetchone()
+                if row is not None and row[0] == self.urlKey(photo):
+                    found[i] = json.loads(row[1])
+        return found
+
+    def addHashes(self, photo, hashes):
+        """Запишет перцептивные хеши фото (None, если изображение не удалось декодировать)."""
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO perceptual VALUES (?, ?, ?)',
+                                    (self.photoKey(photo), self.urlKey(photo), json.dumps(hashes)))
+
+    def forgetDestination(self, destination):
+        """Забудет все загрузки, индекс содержимого и журнал назначения destination (например, оно утеряно)."""
+        with self.lock, self.connection:
+            for table in ('transfers', 'contents', 'checkpoints'):
+                self.connection.execute(f'DELETE FROM {table} WHERE destination = ?', (destination,))
+
+
+class MediaCache:
+    """Кеш скачанных медиафайлов на локальном диске с ограничением по размеру и вытеснением LRU.
+    Ключ - ID фото в источнике, тип размера и ссылка без параметров подписи. Файл сначала пишется
+    во временный файл и атомарно переименовывается; в имени файла хранится его SHA-256,
+    по которому содержимое проверяется перед выдачей из кеша.
+    Все загрузчики одного процесса должны работать с одним обьектом на каталог (см. shared),
+    иначе у каждого свой учет обьема и вытеснение.
+    """
+    stale_temp_age = 3600
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, directory=CACHE_DIR, **kwargs):
+        """Возвратит общий для всего процесса обьект кеша каталога directory, создав его при первом обращении.
+        Параметры kwargs (max_bytes, verify) учитываются только при создании.
+        """
+        key = os.path.abspath(directory)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(directory, **kwargs)
+            return cls.instances[key]
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES, verify=True):
+        """Конструктор класса MediaCache.
+        Примет каталог кеша, допустимый обьем в байтах и признак проверки целостности при чтении.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.tmp'):
+                self.removeStaleTemp(entry)
+            elif entry.is_file():
+                files.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+        for _, name, size in sorted(files):
+            key, _, digest = name.partition('.')
+            self.entries[key] = (digest, size)
+            self.total_bytes += size
+        self.evict()
+        atexit.register(self.printReport)
+
+    def removeStaleTemp(self, entry):
+        """Удалит временный файл entry, брошенный прерванной записью: старше stale_temp_age секунд.
+        Более свежие временные файлы могут принадлежать записи, которая еще идет в другом процессе.
+        """
+        try:
+            if time.time() - entry.stat().st_mtime > self.stale_temp_age:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def key(photo):
+        """Возвратит ключ кеша для фото."""
+        return hashlib.sha1(f"{BackupState.photoKey(photo)}|{BackupState.urlKey(photo)}".encode()).hexdigest()
+
+    def path(self, key, digest):
+        """Возвратит путь к файлу кеша с ключом key и хешем digest."""
+        return os.path.join(self.directory, f"{key}.{digest}")
+
+    def open(self, photo):
+        """Возвратит FileMediaStream с фото из кеша или None, если фото нет или файл поврежден."""
+        key = self.key(photo)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        digest, size = entry
+        path = self.path(key, digest)
+        try:
+            if self.verify and file_sha256(path) != digest:
+                raise OSError(f"Поврежден файл кеша {path}")
+            os.utime(path)
+            stream = FileMediaStream(path, sha256=digest)
+        except OSError:
+            self.discard(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += size
+        return stream
+
+    def discard(self, key):
+        """Удалит запись key из кеша вместе с файлом."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self.total_bytes -= entry[1]
+        try:
+            os.remove(self.path(key, entry[0]))
+        except FileNotFoundError:
+            pass
+
+    def writeThrough(self, photo, chunks):
+        """Генератор кусков chunks, попутно сохраняющий их в кеш.
+        Фото попадает в кеш, только если поток прочитан до конца; иначе временный файл удаляется.
+        """
+        key = self.key(photo)
+        digest = hashlib.sha256()
+        size = 0
+        temp = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            for chunk in chunks:
+                temp.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+            temp.close()
+            self.discard(key)
+            os.replace(temp.name, self.path(key, digest.hexdigest()))
+            with self.lock:
+                self.entries[key] = (digest.hexdigest(), size)
+                self.total_bytes += size
+            self.evict()
+        finally:
+            if not temp.closed:
+                temp.close()
+            if os.path.exists(temp.name):
+                os.remove(temp.name)
+
+    def evict(self):
+        """Удалит давно не использованные файлы, пока обьем кеша больше max_bytes."""
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                key = next(iter(self.entries))
+            self.discard(key)
+
+    def report(self):
+        """Возвратит строку со статистикой кеша: попадания, промахи и сэкономленные байты."""
+        return (f"Кеш медиафайлов: попаданий {self.hits}, промахов {self.misses}, "
+                f"сэкономлено {self.bytes_saved / 1024 / 1024:.1f} Мб, занято {self.total_bytes / 1024 / 1024:.1f} Мб")
+
+    def printReport(self):
+        """Напечатает статистику кеша, если за время работы к нему обращались."""
+        if self.hits or self.misses:
+            print(self.report())
+
+
+def file_sha256(path):
+    """Возвратит SHA-256 содержимого файла path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(partial(file.read, CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_photo(photo, cache=None, dedup=False):
+    """Откроет потоковое скачивание фото по ссылке photo['url'] и возвратит обьект MediaStream.
+    Если задан кеш MediaCache, фото берется из него, а скачанное из сети попутно в него сохраняется.
+    При dedup поток дочитывается заранее, чтобы до загрузки знать SHA-256 содержимого (stream.sha256).
+    Ответ CDN с кодом ошибки выбрасывает requests.HTTPError: такое тело не кешируется и не загружается.
+    """
+    if cache is not None:
+        stream = cache.open(photo)
+        if stream is not None:
+            return stream
+    response = http_sessions.get('cdn').get(photo['url'], stream=True)
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    stream = MediaStream(response)
+    if cache is not None:
+        stream._chunks = cache.writeThrough(photo, stream._chunks)
+    if dedup:
+        stream = SpooledMediaStream(stream)
+    return stream
+
+
+def load_google_api():
+    """Импортирует клиент Google API при первом создании загрузчика Google Drive
+    и создаст класс StreamingMediaUpload. Повторные вызовы ничего не делают.
+    """
+    global MediaUpload, build_http, build, build_from_document, get_static_doc, HttpError
+    global service_account, AuthorizedHttp, StreamingMediaUpload
+    if StreamingMediaUpload is not None:
+        return
+    from googleapiclient.http import MediaUpload, build_http
+    from googleapiclient.discovery import build, build_from_document
+    from googleapiclient.errors import HttpError
+    from google.oauth2 import service_account
+    from google_auth_httplib2 import AuthorizedHttp
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        get_static_doc = None
+    StreamingMediaUpload = type('StreamingMediaUpload', (StreamingMediaSource, MediaUpload), {})
+
+
+def drive_service(credentials, cache_dir=GOOGLE_CACHE_DIR):
+    """Возвратит обьект сервиса Google Drive API v3, не скачивая описание API:
+    берется описание, встроенное в googleapiclient, а в старых версиях без него -
+    копия из папки cache_dir, сохраненная при первом запуске.
+    """
+    load_google_api()
+    document = get_static_doc('drive', 'v3') if get_static_doc is not None else None
+    path = os.path.join(cache_dir, 'drive.v3.json')
+    if document is None and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            document = file.read()
+    if document is not None:
+        return build_from_document(document, credentials=credentials)
+    service = build('drive', 'v3', credentials=credentials, cache_discovery=False)
+    write_json_file(path, service._rootDesc)
+    return service
+
+
+def write_json_file(path, data):
+    """Атомарно запишет data в JSON-файл path, создав его папку."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_imaging():
+    """Импортирует numpy и Pillow при первом поиске похожих фото.
+    Возвратит True, если оба пакета установлены.
+    """
+    global np, Image
+    if np is None or Image is None:
+        try:
+            import numpy as np
+            from PIL import Image
+        except ImportError:
+            np = Image = None
+    return np is not None and Image is not None
 
-class GoogleDriveUploader:
-    SCOPES = ['https://www.googleapis.com/auth/drive']
 
-    def __init__(self, credentials_file_name):
+@lru_cache(maxsize=None)
+def dct_matrix(size):
+    """Возвратит матрицу ортонормированного DCT-II размера size x size."""
+    k = np.arange(size)[:, None]
+    i = np.arange(size)[None, :]
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * i + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def pack_bits(bits):
+    """Возвратит целое число из булева массива bits (старший бит - первый элемент)."""
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def perceptual_hashes(data, hash_size=8):
+    """Примет содержимое изображения data.
+    Возвратит словарь с размерами изображения и его 64-битными перцептивными хешами aHash, dHash и pHash
+    или None, если data не удалось декодировать. Выполняется в отдельном процессе.
+    """
+    load_imaging()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            gray = image.convert('L')
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    pixels = np.asarray(gray.resize((hash_size, hash_size), Image.LANCZOS), dtype=np.float32)
+    a_hash = pack_bits(pixels > pixels.mean())
+    pixels = np.asarray(gray.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.float32)
+    d_hash = pack_bits(pixels[:, 1:] > pixels[:, :-1])
+    dct_size = hash_size * 4
+    matrix = dct_matrix(dct_size)
+    pixels = np.asarray(gray.resize((dct_size, dct_size), Image.LANCZOS), dtype=np.float32)
+    low = (matrix @ pixels @ matrix.T)[:hash_size, :hash_size]
+    p_hash = pack_bits(low > np.median(low.ravel()[1:]))
+    return {'width': width, 'height': height, 'ahash': a_hash, 'dhash': d_hash, 'phash': p_hash}
+
+
+def hamming(a, b):
+    """Возвратит расстояние Хэмминга между двумя хешами."""
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """BK-дерево для поиска хешей в пределах заданного расстояния Хэмминга
+    без попарного сравнения со всеми добавленными хешами.
+    """
+
+    def __init__(self):
+        """Конструктор класса BKTree."""
+        self.root = None
+
+    def add(self, value, item):
+        """Добавит в дерево хеш value с привязанным к нему обьектом item."""
+        node = [value, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, threshold):
+        """Возвратит список пар (расстояние, item) для хешей не дальше threshold от value."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= threshold:
+                found.append((distance, item))
+            for child_distance, child in children.items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    stack.append(child)
+        return found
+
+
+class NearDuplicateDetector:
+    """Поиск почти одинаковых фото (пережатых, уменьшенных копий) по перцептивным хешам.
+    Фото скачиваются потоками (через кеш MediaCache, если он задан - тогда повторная загрузка
+    в облако берет их из кеша), хеши считаются в пуле процессов, соседи ищутся по BK-дереву.
+    Группы ищутся по всему альбому, включая уже загруженные фото. Если задан BackupState, хеши сохраняются в нем,
+    и при следующих запусках скачиваются только новые или изменившиеся фото; без него альбом читается целиком.
+    Нужны numpy и Pillow.
+    """
+
+    def __init__(self, threshold=8, workers=None, download_workers=4, representatives_only=False, batch_size=64):
+        """Конструктор класса NearDuplicateDetector.
+        Примет порог расстояния Хэмминга для pHash и dHash, число процессов и потоков скачивания,
+        признак загрузки только лучшего по разрешению фото из каждой группы и размер пачки для пула процессов.
+        """
+        if not load_imaging():
+            raise RuntimeError('Для поиска похожих фото нужны пакеты numpy и Pillow')
+        self.threshold = threshold
+        self.workers = workers
+        self.download_workers = download_workers
+        self.representatives_only = representatives_only
+        self.batch_size = batch_size
+
+    @staticmethod
+    def readPhoto(photo, cache=None):
+        """Возвратит содержимое фото целиком."""
+        stream = download_photo(photo, cache)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def computeHashes(self, photos, cache=None, state=None):
+        """Возвратит список перцептивных хешей (или None) для каждого фото из списка photos.
+        Хеши, сохраненные в BackupState state, берутся из него, новые в него записываются.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        hashes = {} if state is None else state.findHashes(photos)
+        missing = [i for i in range(len(photos)) if i not in hashes]
+        if not missing:
+            return [hashes[i] for i in range(len(photos))]
+        with ProcessPoolExecutor(self.workers) as processes, ThreadPoolExecutor(self.download_workers) as threads:
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start:start + self.batch_size]
+                futures = [processes.submit(perceptual_hashes, data)
+                           for data in threads.map(partial(self.readPhoto, cache=cache), (photos[i] for i in batch))]
+                for i, future in zip(batch, futures):
+                    hashes[i] = future.result()
+                    if state is not None:
+                        state.addHashes(photos[i], hashes[i])
+        return [hashes[i] for i in range(len(photos))]
+
+    def findGroups(self, hashes):
+        """Примет список хешей. Возвратит группы индексов почти одинаковых фото (из двух и более)
+        и словарь расстояний pHash до соседей.
+        """
+        tree = BKTree()
+        parents = list(range(len(hashes)))
+        distances = {}
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, photo_hashes in enumerate(hashes):
+            if photo_hashes is None:
+                continue
+            for distance, j in tree.search(photo_hashes['phash'], self.threshold):
+                if hamming(photo_hashes['dhash'], hashes[j]['dhash']) <= self.threshold:
+                    parents[find(i)] = find(j)
+                    distances[i] = min(distance, distances.get(i, distance))
+                    distances[j] = min(distance, distances.get(j, distance))
+            tree.add(photo_hashes['phash'], i)
+        groups = {}
+        for i in distances:
+            groups.setdefault(find(i), []).append(i)
+        return [sorted(group) for group in groups.values()], distances
+
+    def run(self, photos, file_path, cache=None, state=None):
+        """Примет фото альбома, путь к папке альбома file_path, кеш MediaCache и BackupState для хешей.
+        Найдет группы почти одинаковых фото и запишет отчет ./file_path/near_duplicates.json.
+        Возвратит список фото для загрузки: все или, при representatives_only,
+        по одному фото с наибольшим разрешением из каждой группы.
+        """
+        photos = list(photos)
+        hashes = self.computeHashes(photos, cache, state)
+        groups, distances = self.findGroups(hashes)
+        dropped = set()
+        report = []
+        for group in groups:
+            best = max(group, key=lambda i: (hashes[i]['width'] * hashes[i]['height'], i))
+            report.append({
+                'representative': photos[best]['file_name'],
+                'photos': [{'file_name': photos[i]['file_name'], 'size': photos[i]['size'],
+                            'width': hashes[i]['width'], 'height': hashes[i]['height'],
+                            'distance': distances[i]} for i in group]
+            })
+            dropped.update(i for i in group if i != best)
+        write_near_duplicates_report(report, file_path)
+        if not self.representatives_only:
+            return photos
+        return [photo for i, photo in enumerate(photos) if i not in dropped]
+
+
+class StorageBackend(ABC):
+    """Общий интерфейс мест хранения фото: облаков, локальной папки и архива.
+    Наследник задает атрибуты class_name, name (профиль назначения для пользователя),
+    destination (ключ назначения в BackupState), max_number_photos, pipeline (TransferPipeline),
+    state, cache, dedup и near_duplicates и реализует prepareFolders и prepareUpload.
+    Отбор фото, пропуск уже загруженных, конвейер и журнал метаданных у всех назначений общие (upload).
+    """
+
+    @abstractmethod
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Создаст папки folder/subfolder/album_name для всех альбомов заранее.
+        Примет имена папок и список названий альбомов.
+        """
+
+    @abstractmethod
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name к загрузке.
+        Возвратит путь папки и функцию send(photo, stream), загружающую в нее одно фото
+        и возвращающую ID или путь сохраненного файла.
+        """
+
+    def bypassPipeline(self, path, photos, metadata):
+        """Возвратит фото, которые нужно передать через конвейер. Наследник может сохранить часть фото
+        другим путем, записав их в журнал метаданных metadata.
+        """
+        return photos
+
+    def reportSuccess(self):
+        """Сообщит об успешной загрузке альбома."""
+        print(f"Успешная загрузка на {self.class_name}!")
+
+    def close(self):
+        """Освободит ресурсы назначения (например, допишет архив), когда загрузок в него больше не будет."""
+
+    @staticmethod
+    def counted(photos, counts, key):
+        """Генератор фото из photos, который считает выданные фото в counts[key]."""
+        for photo in photos:
+            counts[key] += 1
+            yield photo
+
+    def upload(self, photos, folder, subfolder, album_name=None, number_photos=None):
+        """Примет список или генератор записей Photo.
+        Загрузит заданное количество number_photos в папку folder/subfolder/album_name.
+        Запишет метаданные загруженных файлов в ./folder/subfolder/album_name/metadata.jsonl и metadata.json.
+        Возвратит словарь {'uploaded', 'skipped'}: сколько фото загружено и сколько пропущено,
+        потому что они уже есть в назначении."""
+        path, send = self.prepareUpload(folder, subfolder, album_name)
+        if number_photos is None:
+            number = self.max_number_photos
+        else:
+            number = number_photos
+        photos = islice(photos, number)
+        if self.near_duplicates is not None:
+            photos = self.near_duplicates.run(photos, path, self.cache, self.state)
+        counts = {'selected': 0}
+        photos = self.counted(photos, counts, 'selected')
+        download = partial(download_photo, cache=self.cache, dedup=self.dedup)
+        if self.state is not None:
+            photos = self.state.pending(self.destination, path, photos)
+            download = partial(self.state.trackDownload, self.destination, path, download)
+        metadata = MetadataWriter(path)
+        try:
+            photos = self.bypassPipeline(path, photos, metadata)
+            self.pipeline.run(photos, download, metadata.wrap(send, self.destination),
+                              f"Loading {'profile' if album_name is None else album_name}...")
+        finally:
+            metadata.close()
+        self.reportSuccess()
+        return {'uploaded': metadata.recorded, 'skipped': counts['selected'] - metadata.recorded}
+
+
+class GoogleDriveUploader(StorageBackend):
+    SCOPES = ['https://www.googleapis.com/auth/drive']
+    FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+    API_HOST = 'www.googleapis.com'
+    batch_limit = 100
+    batch_retries = 3
+    shared_folder_ttl = 24 * 3600
+
+    def __init__(self, credentials_file_name, download_workers=4, upload_workers=4, queue_size=8, state=None,
+                 cache=None, dedup=False, near_duplicates=None, credentials=None, service=None):
         """Конструктор класса GoogleDriveUploader.
-           Примет путь к файлу с ключами сервисного аккаунта Google.
+           Примет путь к файлу с ключами сервисного аккаунта Google,
+           число параллельных скачиваний, загрузок, размер очереди между ними,
+           хранилище состояния BackupState для пропуска уже загруженных фото,
+           кеш скачанных файлов MediaCache, признак дедупликации по содержимому (нужен state),
+           NearDuplicateDetector для поиска почти одинаковых фото, а также готовые учетные данные
+           и обьект сервиса Drive API (например, для локальных заглушек), если их не нужно создавать из файла.
            """
         self.class_name = 'Google Drive'
         self.SERVICE_ACCOUNT_FILE = credentials_file_name
         self.max_number_photos = 5
-        self.credentials = service_account.Credentials.from_service_account_file(
-            self.SERVICE_ACCOUNT_FILE, scopes=self.SCOPES)
-        self.service = build('drive', 'v3', credentials=self.credentials)
-        results = self.service.files().list(pageSize=10,
-                                            q='sharedWithMe = True',
-                                            fields="nextPageToken, files(id, name, permissions,  mimeType)").execute()
-        self.shared_folder_id = results['files'][0]['id']
-        permissions = results['files'][0]['permissions']
-        for permission in permissions:
-            if permission['role'] == 'owner':
-                self.name = permission['emailAddress']
+        self.pipeline = TransferPipeline(download_workers, upload_workers, queue_size)
+        self.state = state
+        self.cache = cache
+        self.dedup = dedup and state is not None
+        self.near_duplicates = near_duplicates
+        self.local = threading.local()
+        self.folder_ids = {}
+        self.folder_index = {}
+        self.stale_copies = {}
+        self.index_lock = threading.Lock()
+        self.folder_lock = threading.RLock()
+        self.shared_folder = None
+        load_google_api()
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.SERVICE_ACCOUNT_FILE, scopes=self.SCOPES)
+        self.credentials = credentials
+        self.account = getattr(credentials, 'service_account_email', None)
+        if service is None:
+            service = drive_service(self.credentials)
+        self.service = service
+
+    def getSharedFolder(self):
+        """Возвратит словарь {'id', 'owner'} папки, открытой сервисному аккаунту (sharedWithMe),
+        и email ее владельца. Папка ищется при первом обращении, а найденная запоминается
+        в GOOGLE_CACHE_DIR на shared_folder_ttl секунд, чтобы короткие запуски обходились без этого запроса.
+        """
+        with self.folder_lock:
+            if self.shared_folder is not None:
+                return self.shared_folder
+            path = os.path.join(GOOGLE_CACHE_DIR, 'shared_folders.json')
+            cached = {}
+            if self.account is not None and os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as file:
+                    cached = json.load(file)
+            entry = cached.get(self.account)
+            if entry is None or time.time() - entry['time'] > self.shared_folder_ttl:
+                results = self.executeRequest(self.service.files().list(
+                    pageSize=10, q='sharedWithMe = True',
+                    fields="nextPageToken, files(id, name, permissions,  mimeType)"))
+                folder = results['files'][0]
+                owner = next((permission['emailAddress'] for permission in folder['permissions']
+                              if permission['role'] == 'owner'), None)
+                entry = {'id': folder['id'], 'owner': owner, 'time': time.time()}
+                if self.account is not None:
+                    cached[self.account] = entry
+                    write_json_file(path, cached)
+            self.shared_folder = entry
+            return entry
+
+    @property
+    def shared_folder_id(self):
+        return self.getSharedFolder()['id']
+
+    @property
+    def name(self):
+        return self.getSharedFolder()['owner']
+
+    @property
+    def destination(self):
+        return f"gdrive:{self.name}"
+
+    def getHttp(self):
+        """Возвратит авторизованный http-клиент текущего потока: httplib2 не потокобезопасен."""
+        if not hasattr(self.local, 'http'):
+            self.local.http = AuthorizedHttp(self.credentials, http=MeteredHttp(build_http()))
+        return self.local.http
+
+    def executeRequest(self, request):
+        """Выполнит запрос Google Drive API через http-клиент текущего потока.
+        Дождется разрешения планировщика и повторит запрос при 429 и 5xx с экспоненциальной паузой.
+        """
+        scheduler.acquire(self.API_HOST)
+        return request.execute(http=self.getHttp(), num_retries=scheduler.max_retries)
 
     def find_object_by_name(self, name, parent_folder, type_of_object):
         """ Найдет и возвратит список обьектов на Google Drive,
@@ -36,35 +1525,137 @@ class GoogleDriveUploader:
         """
         query = {'folder': f"and mimeType = 'application/vnd.google-apps.folder'",
                  'file': f"and mimeType='image/jpeg'"}
-        response = self.service.files().list(spaces='drive',
-                                             q=f"name = '{name}' and '{parent_folder}'"
-                                               f" in parents {query[type_of_object]}",
-                                             fields="nextPageToken, files(id, name)").execute()
+        escaped_name = name.replace('\\', '\\\\').replace("'", "\\'")
+        request = self.service.files().list(spaces='drive',
+                                            q=f"name = '{escaped_name}' and '{parent_folder}'"
+                                              f" in parents {query[type_of_object]} and trashed = false",
+                                            fields="nextPageToken, files(id, name)")
+        response = self.executeRequest(request)
         return response['files']
 
+    def listFolder(self, folder_id):
+        """Возвратит список файлов папки folder_id на Google Drive, прочитав все страницы.
+        Каждый файл - словарь {'id', 'name', 'mimeType'}; файлы идут от измененных последними к старым.
+        """
+        files = []
+        page_token = None
+        while True:
+            response = self.executeRequest(self.service.files().list(
+                spaces='drive', pageSize=1000, pageToken=page_token, orderBy='modifiedTime desc',
+                q=f"'{folder_id}' in parents and trashed = false",
+                fields="nextPageToken, files(id, name, mimeType)"))
+            files.extend(response['files'])
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return files
+
+    def batchExecute(self, requests_list):
+        """Выполнит запросы Google Drive API пачками BatchHttpRequest по batch_limit (100) за запрос.
+        Примет список обьектов HttpRequest без медиа.
+        Возвратит список пар (ответ, ошибка) в порядке запросов. Запросы, отклоненные из-за лимитов
+        или ошибок сервера (429, 5xx), повторяются следующей пачкой до batch_retries раз.
+        """
+        results = [(None, None)] * len(requests_list)
+        pending = list(range(len(requests_list)))
+        for attempt in range(self.batch_retries + 1):
+            retry = []
+            for start in range(0, len(pending), self.batch_limit):
+                def callback(request_id, response, exception):
+                    index = int(request_id)
+                    results[index] = (response, exception)
+                    status = getattr(getattr(exception, 'resp', None), 'status', None)
+                    if status is not None and (status == 429 or status >= 500):
+                        retry.append(index)
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for index in pending[start:start + self.batch_limit]:
+                    batch.add(requests_list[index], request_id=str(index))
+                scheduler.acquire(self.API_HOST)
+                batch.execute(http=self.getHttp())
+            if not retry:
+                break
+            pending = sorted(retry)
+            time.sleep(2 ** attempt)
+        return results
+
+    def deleteFiles(self, file_ids):
+        """Удалит файлы file_ids с Google Drive пачками запросов, напечатав ошибки отдельных удалений."""
+        requests_list = [self.service.files().delete(fileId=file_id) for file_id in file_ids]
+        for file_id, (_, error) in zip(file_ids, self.batchExecute(requests_list)):
+            if error is not None:
+                print(f"Не удалось удалить файл {file_id}: {error}")
+
+    def getFolderIndex(self, folder_id):
+        """Возвратит индекс {имя файла: ID} папки folder_id.
+        Папка читается один раз за время жизни обьекта, дальше индекс обновляется при загрузке файлов.
+        Из файлов с повторяющимися именами в индекс попадает измененный последним. Более старые копии фото
+        (image/jpeg) запоминаются в stale_copies и удаляются, только когда фото с этим именем загружается снова
+        (см. dropStaleCopies); остальные файлы не трогаются.
+        """
+        with self.index_lock:
+            if folder_id not in self.folder_index:
+                index = {}
+                stale_copies = {}
+                for file in self.listFolder(folder_id):
+                    if file['mimeType'] == self.FOLDER_MIME_TYPE:
+                        self.folder_ids.setdefault((folder_id, file['name']), file['id'])
+                    elif file['name'] not in index:
+                        index[file['name']] = file['id']
+                    elif file['mimeType'] == 'image/jpeg':
+                        stale_copies.setdefault(file['name'], []).append(file['id'])
+                self.folder_index[folder_id] = index
+                self.stale_copies[folder_id] = stale_copies
+            return self.folder_index[folder_id]
+
+    def dropStaleCopies(self, folder_id, file_name):
+        """Удалит более старые копии фото file_name в папке folder_id, найденные при чтении папки."""
+        with self.index_lock:
+            stale_ids = self.stale_copies.get(folder_id, {}).pop(file_name, None)
+        if stale_ids:
+            self.deleteFiles(stale_ids)
+
     def createFolder(self, folder_name, parent_folder_id):
-        """Создаст папку на Google Drive.
-         Примет имя и ID родительской папки.
+        """Создаст папку на Google Drive, если ее еще нет, и возвратит ее ID.
+         Примет имя и ID родительской папки. ID папок кешируются на время жизни обьекта.
          """
-        response = self.service.files().list(spaces='drive',
-                                             q=f"name = '{folder_name}' and '{parent_folder_id}' in parents "
-                                               f"and mimeType = 'application/vnd.google-apps.folder'",
-                                             fields="nextPageToken, files(id, name)").execute()
-        if len(self.find_object_by_name(folder_name, parent_folder_id, 'folder')) == 0:
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
-                'parents': [parent_folder_id]
-            }
-            result = self.service.files().create(body=file_metadata, fields='id').execute()
-            return result['id']
-        else:
-            return response['files'][0]['id']
+        key = (parent_folder_id, folder_name)
+        with self.folder_lock:
+            if key not in self.folder_ids:
+                existed_folders = self.find_object_by_name(folder_name, parent_folder_id, 'folder')
+                if len(existed_folders) == 0:
+                    file_metadata = {
+                        'name': folder_name,
+                        'mimeType': self.FOLDER_MIME_TYPE,
+                        'parents': [parent_folder_id]
+                    }
+                    result = self.executeRequest(self.service.files().create(body=file_metadata, fields='id'))
+                    self.folder_ids[key] = result['id']
+                else:
+                    self.folder_ids[key] = existed_folders[0]['id']
+            return self.folder_ids[key]
 
-    def upload(self, photos, folder, subfolder, album_name=None, number_photos=None):
-        """Примет список словарей в формате {'file_name', 'size', 'url'}.
-        Загрузит заданное количество number_photos на Google Drive: folder/subfolder/album_name.
-        Создаст json-файл с информацией по файлу по адресу: ./folder/subfolder/album_name/metadata.json"""
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Создаст на Google Drive дерево папок folder/subfolder/album_name сразу для всех альбомов.
+        Примет имена папок и список названий альбомов. Содержимое subfolder читается одним списком,
+        а недостающие папки альбомов создаются одной пачкой запросов.
+        """
+        with self.folder_lock:
+            folder_id = self.createFolder(folder, self.shared_folder_id)
+            subfolder_id = self.createFolder(subfolder, folder_id)
+            self.getFolderIndex(subfolder_id)
+            missing = [name for name in dict.fromkeys(album_names) if (subfolder_id, name) not in self.folder_ids]
+            requests_list = [self.service.files().create(body={'name': name,
+                                                               'mimeType': self.FOLDER_MIME_TYPE,
+                                                               'parents': [subfolder_id]}, fields='id')
+                             for name in missing]
+            for name, (response, error) in zip(missing, self.batchExecute(requests_list)):
+                if error is None:
+                    self.folder_ids[(subfolder_id, name)] = response['id']
+
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name на Google Drive к загрузке.
+        Возвратит путь папки и функцию send(photo, stream), загружающую в нее одно фото.
+        """
         folder_id = self.createFolder(folder, self.shared_folder_id)
         subfolder_id = self.createFolder(subfolder, folder_id)
         if album_name is None:
@@ -73,62 +1664,172 @@ class GoogleDriveUploader:
         else:
             parent_folder_id = self.createFolder(album_name, subfolder_id)
             parent_folder_path = f"{folder}/{subfolder}/{album_name}"
-        if number_photos is None:
-            number = self.max_number_photos
-        else:
-            number = number_photos
-
-        for photo in tqdm(photos[:number], ncols=100, desc=f"Loading {'profile' if album_name is None else album_name}"
-                                                           f"...", unit='Kb'):
-            existed_files = self.find_object_by_name(photo['file_name'], parent_folder_id, 'file')
-            if len(existed_files) != 0:
-                self.service.files().delete(fileId=existed_files[0]['id']).execute()
+        self.getFolderIndex(parent_folder_id)
+        return parent_folder_path, partial(self.sendPhoto, parent_folder_id, parent_folder_path)
 
-            response = requests.get(photo['url'])
-            fh = BytesIO(response.content)
-            media_body = MediaIoBaseUpload(fh, mimetype='image/jpeg',
-                                           chunksize=1024 * 1024, resumable=True)
+    def querySession(self, session_uri):
+        """Спросит у Google Drive состояние сессии возобновляемой загрузки session_uri.
+        Возвратит пару (смещение, ответ): число уже принятых байт и None, если загрузка не закончена,
+        или (None, ответ с ID файла), если файл уже загружен целиком. Возвратит None, если сессия истекла.
+        """
+        scheduler.acquire(self.API_HOST)
+        response, content = self.getHttp().request(session_uri, 'PUT',
+                                                    headers={'Content-Length': '0', 'Content-Range': 'bytes */*'})
+        if response.status in (200, 201):
+            return None, json.loads(content)
+        if response.status != 308:
+            return None
+        if 'range' not in response:
+            return 0, None
+        return int(response['range'].split('-')[1]) + 1, None
+
+    def executeUpload(self, request, parent_folder_path, photo):
+        """Выполнит возобновляемую загрузку request по кускам и возвратит ответ Google Drive.
+        После каждого куска записывает в журнал URI сессии и подтвержденное смещение; если в журнале
+        есть незавершенная сессия этого фото (режим resume), продолжит ее с последнего принятого куска.
+        """
+        checkpoint = None
+        if self.state is not None:
+            checkpoint = self.state.getCheckpoint(self.destination, parent_folder_path, photo)
+        if checkpoint is not None and checkpoint[1]:
+            session = self.querySession(checkpoint[1])
+            if session is not None:
+                offset, response = session
+                if response is not None:
+                    return response
+                request.resumable_uri = checkpoint[1]
+                request.resumable_progress = offset
+                request.resumable.seek(offset)
+        response = None
+        while response is None:
+            scheduler.acquire(self.API_HOST)
+            try:
+                _, response = request.next_chunk(http=self.getHttp(), num_retries=scheduler.max_retries)
+            finally:
+                if response is None and request.resumable_uri is not None and self.state is not None:
+                    self.state.checkpoint(self.destination, parent_folder_path, photo, 'uploading',
+                                          request.resumable_uri, request.resumable_progress)
+        return response
+
+    def copyFile(self, file_id, parent_folder_id, file_name):
+        """Скопирует файл file_id на стороне Google Drive в папку parent_folder_id под именем file_name.
+        Возвратит ID копии или None, если исходного файла больше нет.
+        """
+        body = {'name': file_name, 'parents': [parent_folder_id]}
+        try:
+            return self.executeRequest(self.service.files().copy(fileId=file_id, body=body, fields='id'))['id']
+        except HttpError as error:
+            if error.resp.status == 404:
+                return None
+            raise
+
+    def sendPhoto(self, parent_folder_id, parent_folder_path, photo, stream):
+        """Загрузит поток фото stream в папку parent_folder_id (путь parent_folder_path).
+        Файл с тем же именем обновляется новым содержимым через files().update, иначе создается новый.
+        Если такое же содержимое (по stream.sha256) уже загружено, файл не передается заново:
+        он уже на месте или копируется через files().copy.
+        Вызывается из потоков конвейера, поэтому использует http-клиент своего потока.
+        Возвратит ID файла на Google Drive.
+        """
+        index = self.getFolderIndex(parent_folder_id)
+        file_id = index.get(photo['file_name'])
+        self.dropStaleCopies(parent_folder_id, photo['file_name'])
+        known_id = None
+        if self.state is not None and stream.sha256 is not None:
+            known_id = self.state.findContent(self.destination, stream.sha256)
+        if known_id is not None and known_id == file_id:
+            self.state.markDone(self.destination, parent_folder_path, photo, stream.etag)
+            return file_id
+        if known_id is not None and file_id is None:
+            copy_id = self.copyFile(known_id, parent_folder_id, photo['file_name'])
+            if copy_id is None:
+                self.state.dropContent(self.destination, stream.sha256)
+            else:
+                with self.index_lock:
+                    index[photo['file_name']] = copy_id
+                self.state.markDone(self.destination, parent_folder_path, photo, stream.etag)
+                return copy_id
+        media_body = StreamingMediaUpload(stream, mimetype='image/jpeg', chunksize=CHUNK_SIZE)
+        if file_id is not None:
+            self.executeUpload(self.service.files().update(fileId=file_id, media_body=media_body, fields='id'),
+                               parent_folder_path, photo)
+        else:
             file_metadata = {
                 'name': photo['file_name'],
                 'uploadType': 'media',
                 'parents': [parent_folder_id]
             }
-            self.service.files().create(body=file_metadata, media_body=media_body, fields='id').execute()
-        print('Успешная загрузка на Google Drive!')
-        metadata = get_list_metadata(photos[:number])
-        write_metadata(metadata, parent_folder_path)
-
-
-class YandexUploader:
+            result = self.executeUpload(self.service.files().create(body=file_metadata, media_body=media_body,
+                                                                    fields='id'),
+                                        parent_folder_path, photo)
+            file_id = result['id']
+            with self.index_lock:
+                index[photo['file_name']] = file_id
+        if self.state is not None:
+            if stream.sha256 is not None:
+                self.state.addContent(self.destination, stream.sha256, file_id)
+            self.state.markDone(self.destination, parent_folder_path, photo, stream.etag)
+        return file_id
+
+
+class YandexUploader(StorageBackend):
     url = 'https://cloud-api.yandex.net/v1/disk'
+    remote_timeout = 300
 
-    def __init__(self, ya_token):
+    def __init__(self, ya_token, download_workers=4, upload_workers=4, queue_size=8, state=None,
+                 remote_fetch=False, cache=None, dedup=False, near_duplicates=None):
         """Конструктор класса YandexUploader.
-           Примет токен с Полигона Яндекс Диска.
+           Примет токен с Полигона Яндекс Диска,
+           число параллельных скачиваний, загрузок, размер очереди между ними,
+           хранилище состояния BackupState для пропуска уже загруженных фото,
+           признак загрузки по ссылке силами Яндекс Диска (remote_fetch), кеш скачанных файлов MediaCache,
+           признак дедупликации по содержимому (нужен state) и NearDuplicateDetector для поиска почти одинаковых фото.
            """
         self.token = ya_token
         self.class_name = 'Яндекс Диск'
         self.headers = {'Authorization': f'OAuth {self.token}'}
-        self.name = requests.get(self.url, params={'fields': 'user'}, headers=self.headers).json()["user"][
+        self.session = http_sessions.get('yandex')
+        self.name = self.session.get(self.url, params={'fields': 'user'}, headers=self.headers).json()["user"][
             "display_name"]
         self.max_number_photos = 5
+        self.pipeline = TransferPipeline(download_workers, upload_workers, queue_size)
+        self.state = state
+        self.cache = cache
+        self.dedup = dedup and state is not None
+        self.near_duplicates = near_duplicates
+        self.remote_fetch = remote_fetch
+        self.destination = f"yandex:{self.name}"
 
     def createFolder(self, path):
         """Создаст папку на Яндекс Диск по заданному пути path."""
-        url = 'https://cloud-api.yandex.net/v1/disk/resources'
-        headers = {'Authorization': f'OAuth {self.token}'}
+        url = f"{self.url}/resources"
         params = {'path': path}
-        folder_request = requests.get(url, params=params, headers=headers)
+        folder_request = self.session.get(url, params=params, headers=self.headers)
         if folder_request.status_code != 200:
-            folder_response = requests.put(url, params=params, headers=headers)
-            folder_response.raise_for_status()
+            folder_response = self.session.put(url, params=params, headers=self.headers)
+            if folder_response.status_code != 409:
+                folder_response.raise_for_status()
 
-    def upload(self, photos, folder, subfolder, album_name=None, number_photos=None):
-        """Примет список словарей в формате {'file_name', 'size', 'url'},
-        Загрузит заданное количество number_photos на Яндекс Диск: folder/subfolder/album_name.
-        Создаст json-файл с информацией по файлу по адресу: ./folder/subfolder/album_name/metadata.json"""
-        url = "https://cloud-api.yandex.net/v1/disk/resources/upload"
-        headers = {'Authorization': f'OAuth {self.token}'}
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Создаст на Яндекс Диске папки folder/subfolder/album_name для всех альбомов.
+        Примет имена папок и список названий альбомов.
+        """
+        self.createFolder(folder)
+        self.createFolder(f"{folder}/{subfolder}")
+        for album_name in dict.fromkeys(album_names):
+            self.createFolder(f"{folder}/{subfolder}/{album_name}")
+
+    def bypassPipeline(self, path, photos, metadata):
+        """В режиме remote_fetch загрузит фото по ссылкам силами Яндекс Диска
+        и возвратит только те, что придется передать через конвейер."""
+        if self.remote_fetch:
+            return self.remoteUpload(path, photos, metadata)
+        return photos
+
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name на Яндекс Диске к загрузке.
+        Возвратит путь папки и функцию send(photo, stream), загружающую в нее одно фото.
+        """
         self.createFolder(folder)
         self.createFolder(f"{folder}/{subfolder}")
         if album_name is None:
@@ -136,31 +1837,526 @@ class YandexUploader:
         else:
             path = f"{folder}/{subfolder}/{album_name}"
             self.createFolder(path)
+        return path, partial(self.sendPhoto, path)
+
+    def submitRemoteUpload(self, path, photo):
+        """Попросит Яндекс Диск самому скачать фото по ссылке photo['url'] в папку path.
+        Возвратит ссылку на асинхронную операцию или None, если запрос отклонен
+        (например, файл с таким именем уже есть: загрузка по ссылке не перезаписывает файлы).
+        """
+        response = self.session.post(f"{self.url}/resources/upload",
+                                     params={'path': f"{path}/{photo['file_name']}", 'url': photo['url']},
+                                     headers=self.headers)
+        if response.status_code != 202:
+            return None
+        return response.json()['href']
+
+    def getOperationStatus(self, href):
+        """Возвратит статус асинхронной операции Яндекс Диска: 'success', 'failed' или 'in-progress'."""
+        response = self.session.get(href, headers=self.headers)
+        if response.status_code != 200:
+            return 'in-progress' if response.status_code == 429 or response.status_code >= 500 else 'failed'
+        return response.json()['status']
+
+    def remoteUpload(self, path, photos, metadata=None):
+        """Загрузит фото в папку path по ссылкам силами Яндекс Диска, без скачивания через эту машину.
+        Отправит все ссылки альбома, затем опросит операции пачками с растущей паузой.
+        Загруженные фото запишет в журнал метаданных MetadataWriter, если он задан.
+        Возвратит список фото, которые не удалось загрузить так, для загрузки обычным путем.
+        """
+        photos = list(photos)
+        failed = []
+        with ThreadPoolExecutor(self.pipeline.upload_workers) as executor:
+            hrefs = list(executor.map(partial(self.submitRemoteUpload, path), photos))
+            operations = []
+            for photo, href in zip(photos, hrefs):
+                if href is None:
+                    failed.append(photo)
+                else:
+                    operations.append((photo, href))
+            delay = 0.5
+            deadline = time.monotonic() + self.remote_timeout
+            while operations:
+                statuses = list(executor.map(self.getOperationStatus, [href for _, href in operations]))
+                in_progress = []
+                for (photo, href), status in zip(operations, statuses):
+                    if status == 'success':
+                        if self.state is not None:
+                            self.state.markDone(self.destination, path, photo)
+                        if metadata is not None:
+                            metadata.record(photo, self.destination, f"{path}/{photo['file_name']}")
+                    elif status == 'failed':
+                        failed.append(photo)
+                    else:
+                        in_progress.append((photo, href))
+                operations = in_progress
+                if operations and time.monotonic() > deadline:
+                    failed.extend(photo for photo, _ in operations)
+                    break
+                if operations:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 8)
+        print(f"Яндекс Диск загрузил по ссылкам {len(photos) - len(failed)} из {len(photos)} фото")
+        return failed
+
+    def fileExists(self, file_path):
+        """Проверит, есть ли файл file_path на Яндекс Диске."""
+        response = self.session.get(f"{self.url}/resources", params={'path': file_path, 'fields': 'path'},
+                                    headers=self.headers)
+        return response.status_code == 200
+
+    def copyFile(self, source_path, file_path):
+        """Скопирует файл source_path в file_path на стороне Яндекс Диска с перезаписью.
+        Дождется завершения асинхронного копирования. Возвратит False, если скопировать не удалось
+        (например, исходного файла больше нет).
+        """
+        response = self.session.post(f"{self.url}/resources/copy",
+                                     params={'from': source_path, 'path': file_path, 'overwrite': True},
+                                     headers=self.headers)
+        if response.status_code == 201:
+            return True
+        if response.status_code != 202:
+            return False
+        href = response.json()['href']
+        delay = 0.5
+        deadline = time.monotonic() + self.remote_timeout
+        while time.monotonic() < deadline:
+            status = self.getOperationStatus(href)
+            if status != 'in-progress':
+                return status == 'success'
+            time.sleep(delay)
+            delay = min(delay * 2, 8)
+        return False
+
+    def sendPhoto(self, path, photo, stream):
+        """Загрузит поток фото stream в папку path на Яндекс Диске с перезаписью.
+        Данные уходят chunked-запросом по мере скачивания из источника. Яндекс Диск не умеет продолжать
+        прерванную загрузку по ссылке, поэтому после сбоя файл передается заново.
+        Если такое же содержимое (по stream.sha256) уже загружено, файл не передается заново:
+        он уже на месте (это проверяется запросом) или копируется через resources/copy.
+        Возвратит путь файла на Яндекс Диске.
+        """
+        file_path = f"{path}/{photo['file_name']}"
+        if self.state is not None and stream.sha256 is not None:
+            known_path = self.state.findContent(self.destination, stream.sha256)
+            if known_path is not None:
+                if known_path == file_path:
+                    in_place = self.fileExists(file_path)
+                else:
+                    in_place = self.copyFile(known_path, file_path)
+                if in_place:
+                    self.state.markDone(self.destination, path, photo, stream.etag)
+                    return file_path
+                self.state.dropContent(self.destination, stream.sha256)
+        response = self.session.get(
+            f"{self.url}/resources/upload",
+            params={
+                "path": file_path,
+                'overwrite': True
+            },
+            headers=self.headers
+        )
+        href = response.json()["href"]
+        if self.state is not None:
+            self.state.checkpoint(self.destination, path, photo, 'uploading')
+        upload_response = self.session.put(href, data=iter(stream))
+        upload_response.raise_for_status()
+        if self.state is not None:
+            if stream.sha256 is not None:
+                self.state.addContent(self.destination, stream.sha256, file_path)
+            self.state.markDone(self.destination, path, photo, stream.etag)
+        return file_path
+
+
+def safe_path_part(part):
+    """Возвратит часть пути part (название альбома, имя аккаунта) с разделителями папок, замененными на '_'.
+    Выбросит ValueError для пустого имени, '.' и '..', чтобы запись не вышла за пределы корневой папки.
+    """
+    name = str(part).replace(os.sep, '_').replace('/', '_')
+    if os.altsep is not None:
+        name = name.replace(os.altsep, '_')
+    if name in ('', '.', '..'):
+        raise ValueError(f"Недопустимое имя папки: {part!r}")
+    return name
+
+
+def safe_folder_path(folder, subfolder, album_name=None):
+    """Возвратит относительный путь папки folder/subfolder/album_name из безопасных частей (safe_path_part)."""
+    parts = (folder, subfolder) if album_name is None else (folder, subfolder, album_name)
+    return '/'.join(safe_path_part(part) for part in parts)
+
+
+class LocalDirectoryUploader(StorageBackend):
+    """Место хранения в локальной или сетевой (NAS) папке root: фото пишутся в root/folder/subfolder/album_name.
+    Каждый файл пишется буферизованно во временный файл рядом и переименовывается, поэтому прерванная запись
+    не оставляет обрезанных фото. Фото из кеша MediaCache копируются ядром (os.sendfile),
+    а уже сохраненное содержимое (dedup) - жесткой ссылкой.
+    """
+
+    def __init__(self, root, download_workers=4, upload_workers=4, queue_size=8, state=None, cache=None,
+                 dedup=False, near_duplicates=None, buffer_size=CHUNK_SIZE):
+        """Конструктор класса LocalDirectoryUploader.
+        Примет путь к корневой папке копий, число параллельных скачиваний, записей, размер очереди между ними,
+        хранилище состояния BackupState, кеш скачанных файлов MediaCache, признак дедупликации по содержимому
+        (нужен state), NearDuplicateDetector и размер буфера записи.
+        """
+        self.root = os.path.abspath(root)
+        self.class_name = 'локальный диск'
+        self.name = self.root
+        self.destination = f"local:{self.root}"
+        self.max_number_photos = 5
+        self.pipeline = TransferPipeline(download_workers, upload_workers, queue_size)
+        self.state = state
+        self.cache = cache
+        self.dedup = dedup and state is not None
+        self.near_duplicates = near_duplicates
+        self.buffer_size = buffer_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Создаст в корневой папке папки folder/subfolder/album_name для всех альбомов."""
+        os.makedirs(os.path.join(self.root, safe_folder_path(folder, subfolder)), exist_ok=True)
+        for album_name in dict.fromkeys(album_names):
+            os.makedirs(os.path.join(self.root, safe_folder_path(folder, subfolder, album_name)), exist_ok=True)
+
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name в корневой папке к записи.
+        Возвратит путь папки и функцию send(photo, stream), записывающую в нее одно фото.
+        """
+        path = safe_folder_path(folder, subfolder, album_name)
+        os.makedirs(os.path.join(self.root, path), exist_ok=True)
+        return path, partial(self.sendPhoto, path)
+
+    @staticmethod
+    def tempPath(file_path):
+        """Возвратит имя временного файла для записи file_path, свое для каждого потока."""
+        return f"{file_path}.{threading.get_ident()}.tmp"
+
+    def copyFile(self, source_path, file_path):
+        """Сделает file_path копией уже сохраненного файла source_path: жесткой ссылкой, а если
+        файловая система их не поддерживает - обычным копированием.
+        Возвратит False, если исходного файла больше нет.
+        """
+        if not os.path.exists(source_path):
+            return False
+        temp_path = self.tempPath(file_path)
+        try:
+            os.link(source_path, temp_path)
+        except OSError:
+            shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, file_path)
+        return True
+
+    def sendPhoto(self, path, photo, stream):
+        """Запишет поток фото stream в папку path с перезаписью и возвратит путь файла.
+        Если такое же содержимое (по stream.sha256) уже сохранено, файл не пишется заново:
+        он уже на месте или связывается с сохраненным жесткой ссылкой.
+        """
+        file_path = os.path.join(self.root, path, photo['file_name'])
+        if self.state is not None and stream.sha256 is not None:
+            known_path = self.state.findContent(self.destination, stream.sha256)
+            if known_path is not None and (known_path == file_path and os.path.exists(file_path)
+                                           or known_path != file_path and self.copyFile(known_path, file_path)):
+                self.state.markDone(self.destination, path, photo, stream.etag)
+                return file_path
+        temp_path = self.tempPath(file_path)
+        try:
+            with open(temp_path, 'wb', buffering=self.buffer_size) as file:
+                stream.writeTo(file)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        if self.state is not None:
+            if stream.sha256 is not None:
+                self.state.addContent(self.destination, stream.sha256, file_path)
+            self.state.markDone(self.destination, path, photo, stream.etag)
+        return file_path
+
+
+class ArchiveUploader(StorageBackend):
+    """Место хранения в одном архиве tar или zip для холодного хранения: фото становятся элементами
+    folder/subfolder/album_name/file_name. Элементы пишутся по одному под блокировкой; фото, размер которых
+    заранее неизвестен (прямо из сети), сначала дочитываются в SpooledMediaStream, чтобы не держать архив
+    занятым на время скачивания. Сжатие не используется: JPEG уже сжаты. Существующий архив дополняется.
+    Архив дописывается при выходе из программы или вызове close(); zip без этого будет неполным,
+    поэтому фото, записанные в zip, отмечаются в BackupState загруженными только после успешного close().
+    Zip без читаемого оглавления (запись прервалась) не дополняется: он переименовывается в *.broken,
+    а его записи в BackupState удаляются, чтобы все фото были записаны в новый архив заново.
+    """
+
+    def __init__(self, path, download_workers=4, upload_workers=4, queue_size=8, state=None, cache=None,
+                 near_duplicates=None, archive_format=None, buffer_size=CHUNK_SIZE):
+        """Конструктор класса ArchiveUploader.
+        Примет путь к файлу архива, число параллельных скачиваний, записей, размер очереди между ними,
+        хранилище состояния BackupState, кеш скачанных файлов MediaCache, NearDuplicateDetector,
+        формат 'tar' или 'zip' (по умолчанию по расширению файла) и размер буфера записи.
+        """
+        self.path = os.path.abspath(path)
+        self.format = archive_format or ('zip' if self.path.lower().endswith('.zip') else 'tar')
+        self.class_name = f"архив {self.format}"
+        self.name = self.path
+        self.destination = f"{self.format}:{self.path}"
+        self.max_number_photos = 5
+        self.pipeline = TransferPipeline(download_workers, upload_workers, queue_size)
+        self.state = state
+        self.cache = cache
+        self.dedup = False
+        self.near_duplicates = near_duplicates
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.unconfirmed = []
+        if self.format == 'zip' and os.path.exists(self.path) and not self.isReadableZip(self.path):
+            os.replace(self.path, f"{self.path}.broken")
+            print(f"Архив {self.path} поврежден и переименован в {self.path}.broken, он будет записан заново")
+            if self.state is not None:
+                self.state.forgetDestination(self.destination)
+        mode = 'a' if os.path.exists(self.path) else 'w'
+        if self.format == 'zip':
+            self.archive = zipfile.ZipFile(self.path, mode, zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self.archive = tarfile.open(self.path, mode, format=tarfile.PAX_FORMAT, copybufsize=buffer_size)
+        atexit.register(self.close)
+
+    @staticmethod
+    def isReadableZip(path):
+        """Проверит, что у zip-файла path есть читаемое оглавление."""
+        try:
+            zipfile.ZipFile(path).close()
+        except (zipfile.BadZipFile, OSError):
+            return False
+        return True
+
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Папки в архиве создавать не нужно."""
+
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Возвратит путь папки folder/subfolder/album_name в архиве из безопасных частей
+        и функцию send(photo, stream), записывающую в архив одно фото.
+        """
+        path = safe_folder_path(folder, subfolder, album_name)
+        return path, partial(self.sendPhoto, path)
+
+    def reportSuccess(self):
+        print(f"Фото записаны в {self.class_name} {self.path}")
+
+    def sendPhoto(self, path, photo, stream):
+        """Запишет поток фото stream в архив элементом path/file_name и возвратит имя элемента."""
+        member_name = f"{path}/{photo['file_name']}"
+        source = stream if stream.size is not None else SpooledMediaStream(stream)
+        try:
+            with self.lock:
+                if self.format == 'zip':
+                    info = zipfile.ZipInfo(member_name, time.localtime()[:6])
+                    info.file_size = source.size
+                    with self.archive.open(info, 'w') as member:
+                        source.writeTo(member)
+                else:
+                    info = tarfile.TarInfo(member_name)
+                    info.size = source.size
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                    self.archive.addfile(info, source)
+        finally:
+            if source is not stream:
+                source.close()
+        if self.state is None:
+            return member_name
+        if self.format == 'zip':
+            with self.lock:
+                self.unconfirmed.append((path, photo, stream.etag))
+        else:
+            self.state.markDone(self.destination, path, photo, stream.etag)
+        return member_name
+
+    def close(self):
+        """Допишет и закроет архив, после чего отметит в BackupState записанные в zip фото.
+        Повторные вызовы ничего не делают.
+        """
+        with self.lock:
+            if self.archive is None:
+                return
+            self.archive.close()
+            self.archive = None
+            unconfirmed, self.unconfirmed = self.unconfirmed, []
+        for path, photo, etag in unconfirmed:
+            self.state.markDone(self.destination, path, photo, etag)
+
+
+class PartialUploadError(Exception):
+    """Часть назначений MultiUploader не приняла фото.
+    В failures - словарь {название назначения: список пар (имя файла, ошибка)}.
+    """
+
+    def __init__(self, failures):
+        """Конструктор класса PartialUploadError. Примет словарь ошибок по назначениям."""
+        self.failures = failures
+        super().__init__('; '.join(f"{name}: не загружено {len(errors)} фото, первая ошибка: {errors[0][1]}"
+                                   for name, errors in failures.items()))
+
+
+class MultiUploader(StorageBackend):
+    """Загрузчик сразу в несколько облаков: каждое фото скачивается из источника один раз,
+    а его поток раздается всем назначениям параллельно. Ошибка одного назначения не мешает остальным,
+    но после загрузки альбома выбрасывается PartialUploadError со списком незагруженных фото.
+    Режим загрузки по ссылке (remote_fetch) здесь не используется.
+    """
+
+    def __init__(self, uploaders, download_workers=4, upload_workers=4, queue_size=8, cache=None, dedup=False,
+                 near_duplicates=None):
+        """Конструктор класса MultiUploader.
+        Примет список загрузчиков (GoogleDriveUploader, YandexUploader),
+        число параллельных скачиваний, загрузок, размер очереди между ними, кеш скачанных файлов MediaCache,
+        признак дедупликации по содержимому и NearDuplicateDetector для поиска почти одинаковых фото.
+        """
+        self.uploaders = uploaders
+        self.class_name = ' + '.join(uploader.class_name for uploader in uploaders)
+        self.max_number_photos = min(uploader.max_number_photos for uploader in uploaders)
+        self.cache = cache
+        self.dedup = dedup
+        self.near_duplicates = near_duplicates
+        self.pipeline = TransferPipeline(download_workers, upload_workers, queue_size)
+        self.executor = ThreadPoolExecutor(self.pipeline.upload_workers * len(uploaders))
+
+    @property
+    def name(self):
+        return ', '.join(uploader.name for uploader in self.uploaders)
+
+    def prepareFolders(self, folder, subfolder, album_names):
+        """Создаст папки всех альбомов в каждом из назначений."""
+        for uploader in self.uploaders:
+            uploader.prepareFolders(folder, subfolder, album_names)
+
+    def prepareTargets(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name в каждом из назначений.
+        Возвратит список назначений: троек (загрузчик, путь папки, send).
+        """
+        return [(uploader, *uploader.prepareUpload(folder, subfolder, album_name)) for uploader in self.uploaders]
+
+    def prepareUpload(self, folder, subfolder, album_name=None):
+        """Подготовит папку folder/subfolder/album_name во всех назначениях.
+        Возвратит путь папки в первом назначении и функцию send(photo, stream), загружающую одно фото
+        во все назначения, где его еще нет. Если часть назначений фото не приняла, send выбросит PartialUploadError.
+        """
+        targets = self.prepareTargets(folder, subfolder, album_name)
+        return targets[0][1], partial(self.sendPhoto, targets)
+
+    def sendPhoto(self, targets, photo, stream):
+        """Раздаст поток фото stream назначениям targets и возвратит путь фото в первом назначении."""
+        failures = [[] for _ in targets]
+        self.sendToAll(targets, None, failures, photo, stream)
+        failed = {uploader.class_name: errors for (uploader, _, _), errors in zip(targets, failures) if errors}
+        if failed:
+            raise PartialUploadError(failed)
+        return f"{targets[0][1]}/{photo['file_name']}"
+
+    def close(self):
+        """Закроет все назначения."""
+        for uploader in self.uploaders:
+            uploader.close()
+
+    @staticmethod
+    def isDone(target, photo):
+        """Проверит, загружено ли фото в назначение target = (загрузчик, путь, send)."""
+        uploader, path, _ = target
+        return uploader.state is not None and uploader.state.isDone(uploader.destination, path, photo)
+
+    @staticmethod
+    def sendBranch(send, photo, branch):
+        """Загрузит ветку потока в одно назначение и закроет ее, даже если загрузка не удалась."""
+        try:
+            send(photo, branch)
+        finally:
+            branch.close()
+
+    def sendToAll(self, targets, progress_bars, failures, photo, stream):
+        """Раздаст поток фото stream всем назначениям, где этого фото еще нет, показывая прогресс
+        в progress_bars (если заданы). Ошибки назначений собираются в списки failures и не прерывают загрузку
+        в остальные.
+        """
+        pending = [i for i, target in enumerate(targets) if not self.isDone(target, photo)]
+        if not pending:
+            return
+        branches = []
+        for i in pending:
+            branch = TeeStream(stream)
+            if progress_bars is not None:
+                branch.callback = progress_bars[i].update
+            branches.append(branch)
+        futures = [self.executor.submit(self.sendBranch, targets[i][2], photo, branch)
+                   for i, branch in zip(pending, branches)]
+        try:
+            for chunk in stream:
+                for branch in branches:
+                    branch.feed(chunk)
+                if all(branch.closed for branch in branches):
+                    break
+        except Exception as error:
+            for branch in branches:
+                branch.feed(error)
+        else:
+            for branch in branches:
+                branch.feed(None)
+        for i, future in zip(pending, futures):
+            error = future.exception()
+            if error is not None:
+                failures[i].append((photo['file_name'], error))
+
+    def upload(self, photos, folder, subfolder, album_name=None, number_photos=None):
+        """Примет список или генератор словарей в формате {'file_name', 'size', 'url'}.
+        Загрузит заданное количество number_photos во все назначения: folder/subfolder/album_name.
+        Запишет метаданные загруженных файлов в ./folder/subfolder/album_name/metadata.jsonl и metadata.json.
+        Возвратит словарь {'uploaded', 'skipped'}: сколько фото загружено хотя бы в одно назначение
+        и сколько пропущено, потому что они уже есть во всех.
+        Если хотя бы одно назначение не приняло часть фото, выбросит PartialUploadError."""
+        targets = self.prepareTargets(folder, subfolder, album_name)
         if number_photos is None:
             number = self.max_number_photos
         else:
             number = number_photos
-        for photo in tqdm(photos[:number], ncols=100, desc=f"Loading {'profile' if album_name is None else album_name}"
-                                                           f"...", unit='Kb'):
-            response = requests.get(
-                url,
-                params={
-                    "path": f"{path}/{photo['file_name']}",
-                    'overwrite': True
-                },
-                headers=headers
-            )
-            href = response.json()["href"]
-            photo_response = requests.get(photo['url'])
-            upload_response = requests.put(href, data=photo_response.content)
-            upload_response.raise_for_status()
-        metadata = get_list_metadata(photos[:number])
-        write_metadata(metadata, path)
-        return print('Успешная загрузка на Яндекс Диск!')
+        photos = islice(photos, number)
+        if self.near_duplicates is not None:
+            photos = self.near_duplicates.run(photos, targets[0][1], self.cache, targets[0][0].state)
+        writers = {path: MetadataWriter(path) for _, path, _ in targets}
+        targets = [(uploader, path, writers[path].wrap(send, uploader.destination))
+                   for uploader, path, send in targets]
+        counts = {'selected': 0, 'uploaded': 0}
+        photos = self.counted(photos, counts, 'selected')
+        photos = (photo for photo in photos if not all(self.isDone(target, photo) for target in targets))
+        photos = self.counted(photos, counts, 'uploaded')
+        failures = [[] for _ in targets]
+        from tqdm.auto import tqdm
+        progress_bars = [tqdm(ncols=100, desc=f"  {uploader.class_name}", position=i + 1, leave=False,
+                              unit='B', unit_scale=True, unit_divisor=1024)
+                         for i, (uploader, _, _) in enumerate(targets)]
+        try:
+            self.pipeline.run(photos, partial(download_photo, cache=self.cache, dedup=self.dedup),
+                              partial(self.sendToAll, targets, progress_bars, failures),
+                              f"Loading {'profile' if album_name is None else album_name}...")
+        finally:
+            for progress in progress_bars:
+                progress.close()
+            for metadata in writers.values():
+                metadata.close()
+        failed = {}
+        for (uploader, path, _), errors in zip(targets, failures):
+            if errors:
+                failed[uploader.class_name] = errors
+            else:
+                uploader.reportSuccess()
+        if failed:
+            raise PartialUploadError(failed)
+        return {'uploaded': counts['uploaded'], 'skipped': counts['selected'] - counts['uploaded']}
+
+
+class VkApiError(Exception):
+    """Ошибка VK API, которая не исчезла после всех повторов."""
 
 
 class Vk:
     url = 'https://api.vk.com/method/'
+    execute_limit = 25
+    retry_codes = (1, 6, 10)
 
     def __init__(self, vk_token, version):
         """Конструктор класса Vk.
@@ -168,6 +2364,7 @@ class Vk:
         """
         self.token = vk_token
         self.class_name = 'VKontakte'
+        self.session = http_sessions.get('vk')
         self.version = version
         self.params = {
             'access_token': self.token,
@@ -176,94 +2373,224 @@ class Vk:
 
     def targetUserExists(self, target_id):
         """Проверит, есть ли доступ к аккаунту с target_id"""
-        users_info_url = self.url + 'users.get'
         users_info_params = {
             'user_ids': target_id
         }
-        response = requests.get(users_info_url, params={**self.params, **users_info_params})
+        response = self.request('users.get', users_info_params)
         try:
-            return response.json()['response']
+            return response['response']
         except KeyError:
-            print(response.json()['error']['error_msg'])
+            print(response['error']['error_msg'])
             return False
 
+    def request(self, method, params, post=False):
+        """Вызовет метод VK API и возвратит разобранный JSON-ответ.
+        Примет название метода, параметры и признак POST-запроса. При ошибках частоты запросов (код 6)
+        и внутренних ошибках VK повторит вызов с паузой, а если повторы исчерпаны, выбросит VkApiError.
+        """
+        for attempt in count():
+            if post:
+                response = self.session.post(self.url + method, data={**self.params, **params}).json()
+            else:
+                response = self.session.get(self.url + method, params={**self.params, **params}).json()
+            error = response.get('error')
+            if error is None or error['error_code'] not in self.retry_codes:
+                return response
+            if attempt >= scheduler.max_retries:
+                raise VkApiError(f"{method}: {error['error_msg']}")
+            if metrics.enabled:
+                metrics.retry(endpoint_name('POST' if post else 'GET', self.url + method))
+            scheduler.wait(attempt)
+
+    def callMethod(self, method, params):
+        """Вызовет метод VK API и возвратит значение 'response'.
+        Примет название метода и его параметры. При ошибке доступа напечатает ее описание и возвратит None.
+        """
+        response = self.request(method, params)
+        try:
+            return response['response']
+        except KeyError:
+            print(response['error']['error_msg'])
+            return None
+
+    def executeBatch(self, calls):
+        """Выполнит вызовы методов VK API через метод execute, группируя их по execute_limit (25) за запрос.
+        Примет список пар (название метода, параметры).
+        Возвратит список значений 'response' в порядке вызовов, None для вызовов с ошибкой.
+        Вызовы, отклоненные из-за частоты запросов, повторяются следующими пачками с паузой.
+        Если сам запрос execute завершился ошибкой, выбросит VkApiError, чтобы не потерять всю пачку.
+        """
+        results = [None] * len(calls)
+        pending = list(range(len(calls)))
+        for attempt in count():
+            retry = []
+            for start in range(0, len(pending), self.execute_limit):
+                batch = pending[start:start + self.execute_limit]
+                code = 'return [' + ','.join(f"API.{calls[index][0]}({json.dumps(calls[index][1], ensure_ascii=False)})"
+                                             for index in batch) + '];'
+                response = self.request('execute', {'code': code}, post=True)
+                if 'response' not in response:
+                    raise VkApiError(f"execute: {response['error']['error_msg']}")
+                errors = iter(response.get('execute_errors', []))
+                for index, result in zip(batch, response['response']):
+                    if result is not False:
+                        results[index] = result
+                        continue
+                    error = next(errors, {'error_code': None, 'error_msg': 'execute: неизвестная ошибка'})
+                    if error['error_code'] in self.retry_codes:
+                        retry.append(index)
+                    else:
+                        print(error['error_msg'])
+            if not retry:
+                return results
+            if attempt >= scheduler.max_retries:
+                raise VkApiError(f"execute: {len(retry)} вызовов отклонены после {attempt + 1} попыток")
+            scheduler.wait(attempt)
+            pending = retry
+
 
 class VkUser(Vk):
-    def __init__(self, vk_token, version, target_id):
+    page_size = 1000
+
+    def __init__(self, vk_token, version, target_id, parallel_pages=False, page_workers=4):
         """Конструктор класса VkUser.
-        Примет токен аккаунта VK, номер версии и ID искомого пользователя.
+        Примет токен аккаунта VK, номер версии, ID искомого пользователя,
+        признак параллельного чтения страниц и число потоков для него.
         """
         super().__init__(vk_token, version)
+        self.parallel_pages = parallel_pages
+        self.page_workers = page_workers
         self.params = {
             'access_token': self.token,
             'v': self.version,
             'user_ids': target_id
         }
         self.target_id = target_id
-        self.target_first_name = requests.get(self.url + 'users.get', self.params).json()['response'][0]['first_name']
-        self.target_last_name = requests.get(self.url + 'users.get', self.params).json()['response'][0]['last_name']
+        target_info = self.callMethod('users.get', {})[0]
+        self.target_first_name = target_info['first_name']
+        self.target_last_name = target_info['last_name']
         self.target_name = f"{self.target_first_name} {self.target_last_name}"
 
-    def getPhotos(self, owner_id, album_id=None):
-        """Возвратит список значений 'items' обьекта response.
-        Примет ID пользоватееля VK и ID альбома"""
-        users_photos_url = self.url + 'photos.get'
-        if album_id is None:
-            album_id = 'profile'
-        users_photos_params = {
+    def getPhotosParams(self, owner_id, album_id, offset, count=None):
+        """Возвратит параметры метода photos.get для страницы альбома.
+        Примет ID пользователя VK, ID альбома, смещение и размер страницы."""
+        return {
             'owner_id': owner_id,
             'album_id': album_id,
             'extended': 1,
-            'photo_sizes': 1
+            'photo_sizes': 1,
+            'offset': offset,
+            'count': self.page_size if count is None else count
         }
-        items = []
-        response = requests.get(users_photos_url, params={**self.params, **users_photos_params})
+
+    def getPhotosPage(self, owner_id, album_id, offset, count=None):
+        """Возвратит страницу обьекта response метода photos.get: {'count', 'items'} или None при ошибке.
+        Примет ID пользователя VK, ID альбома, смещение и размер страницы."""
+        return self.callMethod('photos.get', self.getPhotosParams(owner_id, album_id, offset, count))
+
+    def getPhotosCount(self, owner_id, album_id=None):
+        """Возвратит количество фото в альбоме, 0 при ошибке доступа.
+        Примет ID пользоватееля VK и ID альбома"""
+        page = self.getPhotosPage(owner_id, 'profile' if album_id is None else album_id, 0, 1)
+        return 0 if page is None else page['count']
+
+    def iterPhotos(self, owner_id, album_id=None, parallel=None, first_page=None):
+        """Генератор значений 'items' обьекта response по всем страницам альбома.
+        Примет ID пользоватееля VK, ID альбома, признак параллельного чтения страниц
+        и уже полученную первую страницу альбома, если она есть (см. getAlbumsFirstPages).
+        В параллельном режиме после первой страницы известен 'count', и остальные смещения
+        запрашиваются одновременно в page_workers потоках, сохраняя порядок фото."""
+        if album_id is None:
+            album_id = 'profile'
+        if parallel is None:
+            parallel = self.parallel_pages
+        page = self.getPhotosPage(owner_id, album_id, 0) if first_page is None else first_page
+        if page is None:
+            return
+        yield from page['items']
+        offsets = range(self.page_size, page['count'], self.page_size)
+        if not parallel:
+            for offset in offsets:
+                page = self.getPhotosPage(owner_id, album_id, offset)
+                if page is None:
+                    return
+                yield from page['items']
+            return
+        executor = ThreadPoolExecutor(self.page_workers)
         try:
-            items = response.json()['response']['items']
-        except KeyError:
-            print(response.json()['error']['error_msg'])
-        return items
+            for page in executor.map(partial(self.getPhotosPage, owner_id, album_id), offsets):
+                if page is None:
+                    return
+                yield from page['items']
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def getPhotos(self, owner_id, album_id=None):
+        """Возвратит список значений 'items' обьекта response со всех страниц альбома.
+        Примет ID пользоватееля VK и ID альбома"""
+        return list(self.iterPhotos(owner_id, album_id))
+
+    def getAlbumsFirstPages(self, owner_id, album_ids):
+        """Возвратит словарь {ID альбома: первая страница {'count', 'items'}} для заданных альбомов.
+        Примет ID пользоватееля VK и список ID альбомов. Первые страницы запрашиваются пачками через execute;
+        для альбомов без доступа возвращается пустая страница. Остальные страницы читает iterPhotos
+        во время загрузки альбома."""
+        pages = self.executeBatch([('photos.get', self.getPhotosParams(owner_id, album_id, 0))
+                                   for album_id in album_ids])
+        return {album_id: {'count': 0, 'items': []} if page is None else page
+                for album_id, page in zip(album_ids, pages)}
+
+    def iterAlbums(self, owner_id):
+        """Генератор альбомов пользователя VK постранично.
+        Примет ID пользоватееля"""
+        offset = 0
+        while True:
+            users_albums_params = {
+                'owner_id': owner_id,
+                'offset': offset,
+                'count': self.page_size
+            }
+            response = self.callMethod('photos.getAlbums', users_albums_params)
+            if response is None:
+                return
+            yield from response['items']
+            offset += len(response['items'])
+            if len(response['items']) == 0 or offset >= response['count']:
+                return
 
     def getAlbumsInfo(self, owner_id):
-        """Возвратит список ID и названий альбомов пользоватееля VK.
+        """Возвратит список ID, названий и размеров альбомов пользоватееля VK.
         Примет ID пользоватееля"""
         albums = []
-        users_albums_url = self.url + 'photos.getAlbums'
-        users_albums_params = {
-            'owner_id': owner_id
-        }
-        response = requests.get(users_albums_url, params={**self.params, **users_albums_params})
-        try:
-            items = response.json()['response']['items']
-        except KeyError:
-            print(response.json()['error']['error_msg'])
-            return albums
-        for item in items:
-            albums.append({'id': item['id'], 'title': item['title']})
+        for item in self.iterAlbums(owner_id):
+            albums.append({'id': item['id'], 'title': item['title'], 'size': item['size']})
         return albums
 
 
 class Insta:
+    graph_url = 'https://graph.facebook.com/'
+
     def __init__(self, token, version):
         """Конструктор класса Insta.
         Примет токен аккаунта Instagram Graph API и номер версии.
         """
-        self.url = f"https://graph.facebook.com/{version}/"
+        self.url = f"{self.graph_url}{version}/"
         self.access_token = token
         self.class_name = 'Instagram'
+        self.session = http_sessions.get('graph')
         self.params = {
             'access_token': self.access_token,
             'fields': 'instagram_business_account'
         }
-        self.page_id = requests.get(self.url + 'me/accounts', self.params).json()['data'][0]['id']
+        self.page_id = self.session.get(self.url + 'me/accounts', self.params).json()['data'][0]['id']
         self.instagram_account_id = \
-            requests.get(self.url + self.page_id + '/', self.params).json()['instagram_business_account']['id']
+            self.session.get(self.url + self.page_id + '/', self.params).json()['instagram_business_account']['id']
 
     def targetUserExists(self, target_ig_username):
         """Проверит, есть ли доступ к аккаунту с именем target_ig_username"""
-        self.params['fields'] = f"business_discovery.username({target_ig_username})"
+        params = dict(self.params, fields=f"business_discovery.username({target_ig_username})")
         url = self.url + self.instagram_account_id
-        response = requests.get(url, self.params)
+        response = self.session.get(url, params)
         try:
             return response.status_code == 200
         except KeyError:
@@ -272,87 +2599,235 @@ class Insta:
 
 
 class InstaUser(Insta):
-    def __init__(self, token, version, target_ig_username):
+    def __init__(self, token, version, target_ig_username, page_limit=100, client=None):
         """Конструктор класса InstaUser, наследник от Insta.
-        Примет токен аккаунта Instagram Graph API, номер версии и имя искомого пользователя
+        Примет токен аккаунта Instagram Graph API, номер версии, имя искомого пользователя,
+        размер страницы при чтении медиафайлов и, если он уже есть, обьект Insta с тем же токеном,
+        чтобы не запрашивать заново ID страницы и бизнес-аккаунта.
         """
-        super().__init__(token, version)
-        self.url = f"https://graph.facebook.com/{version}/{self.instagram_account_id}/"
+        if client is None:
+            super().__init__(token, version)
+        else:
+            self.access_token = token
+            self.class_name = client.class_name
+            self.session = client.session
+            self.params = dict(client.params)
+            self.page_id = client.page_id
+            self.instagram_account_id = client.instagram_account_id
+        self.url = f"{self.graph_url}{version}/{self.instagram_account_id}/"
+        self.page_limit = page_limit
         self.params['fields'] = f"business_discovery.username({target_ig_username})" \
-                                f"{{username,ig_id,id,media_count,profile_picture_url}}"
-        self.target_media_count = requests.get(self.url, self.params).json()['business_discovery']['media_count']
+                                f"{{media_count,profile_picture_url}}"
+        profile = self.session.get(self.url, self.params).json()['business_discovery']
+        self.target_media_count = profile['media_count']
         self.target_name = target_ig_username
-        self.profile_picture_url = \
-            requests.get(self.url, self.params).json()['business_discovery']['profile_picture_url']
+        self.profile_picture_url = profile['profile_picture_url']
+
+    def iterPhotos(self, limit=None):
+        """Генератор значений 'data' медиафайлов пользователя Instagram по всем страницам.
+        Примет размер страницы (по умолчанию page_limit) и следует курсору 'after' до последней страницы.
+        """
+        if limit is None:
+            limit = self.page_limit
+        after = ''
+        while True:
+            self.params['fields'] = f"business_discovery.username({self.target_name})" \
+                                    f"{{media{after}.limit({limit}){{id,media_type,timestamp,media_url,like_count}}}}"
+            media = self.session.get(self.url, self.params).json()['business_discovery']['media']
+            yield from media['data']
+            cursor = media.get('paging', {}).get('cursors', {}).get('after')
+            if len(media['data']) < limit or cursor is None:
+                return
+            after = f".after({cursor})"
 
     def getPhotos(self):
         """Возвратит список значений 'data' медафайлов пользователя Instagram"""
-        self.params['fields'] = f"business_discovery.username({self.target_name})" \
-                                f"{{media{{media_type,timestamp,media_url,like_count}}}}"
-        photos = \
-            requests.get(self.url, self.params).json()['business_discovery']['media']['data']
-        return photos
+        return list(self.iterPhotos())
+
+
+class Photo:
+    """Запись о фото для загрузки с полями id, album_id, file_name, size, url.
+    Поля хранятся в слотах, поэтому запись занимает в несколько раз меньше памяти, чем словарь.
+    Читается и как словарь (photo['url'], photo.get('id')), как это делают загрузчики.
+    """
+    __slots__ = ('id', 'album_id', 'file_name', 'size', 'url')
+
+    def __init__(self, photo_id, album_id, file_name, size, url):
+        """Конструктор класса Photo.
+        Примет ID фото, ID альбома, имя файла, тип размера и ссылку на файл.
+        """
+        self.id = photo_id
+        self.album_id = album_id
+        self.file_name = file_name
+        self.size = size
+        self.url = url
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __repr__(self):
+        return f"Photo({self.id!r}, {self.album_id!r}, {self.file_name!r}, {self.size!r}, {self.url!r})"
+
+
+class UniqueFileNames:
+    """Выдает имена файлов, уникальные в пределах одного альбома; проверка имени - поиск в множестве."""
+
+    def __init__(self):
+        """Конструктор класса UniqueFileNames."""
+        self.used = set()
+        self.numbers = {}
+
+    def take(self, stem, fallback_stem, extension='.jpg'):
+        """Возвратит имя stem + extension, если оно свободно, иначе fallback_stem + extension,
+        а если занято и оно - fallback_stem с первым свободным номером: _2, _3 и так далее.
+        """
+        file_name = f"{stem}{extension}"
+        if file_name in self.used:
+            file_name = f"{fallback_stem}{extension}"
+        if file_name in self.used:
+            number = self.numbers.get(fallback_stem, 1)
+            while file_name in self.used:
+                number += 1
+                file_name = f"{fallback_stem}_{number}{extension}"
+            self.numbers[fallback_stem] = number
+        self.used.add(file_name)
+        return file_name
+
+
+def vk_largest_size(sizes):
+    """Возвратит из списка размеров фото VK размер с наибольшей площадью width * height.
+    У старых фото ширина и высота бывают нулевыми - тогда выбирается последний размер, как раньше.
+    """
+    return max(enumerate(sizes), key=lambda pair: (pair[1].get('width', 0) * pair[1].get('height', 0), pair[0]))[1]
 
 
 def vk_get_list_for_load(items):
-    """Примет список обьектов фотографий пользователя VK.
-    Возвратит список словарей с ключами {'file_name', 'size', 'url'}.
+    """Примет итерируемый обьект фотографий пользователя VK.
+    Вернет генератор записей Photo с уникальными в альбоме именами файлов.
     """
-    photos_metadata = []
-    file_name_list = []
+    file_names = UniqueFileNames()
     for item in items:
-        file_name = f"{str(item['likes']['count'])}.jpg"
-        if file_name in file_name_list:
-            file_name = f"{str(item['likes']['count'])}{str(item['date'])}.jpg"
-        size = item['sizes'][-1]['type']
-        url = item['sizes'][-1]['url']
-        file_name_list.append(file_name)
-        album_id = item['album_id']
-        photos_metadata.append({'album_id': album_id, 'file_name': file_name, 'size': size, 'url': url})
-    return photos_metadata
+        likes = item['likes']['count']
+        size = vk_largest_size(item['sizes'])
+        yield Photo(f"{item['owner_id']}_{item['id']}", item['album_id'],
+                    file_names.take(likes, f"{likes}{item['date']}"), size['type'], size['url'])
 
 
 def ig_get_list_for_load(medias):
-    """Примет список обьектов фотографий пользователя Instagram.
-    Возвратит список словарей с ключами {'file_name', 'size', 'url'}.
+    """Примет итерируемый обьект медиафайлов пользователя Instagram.
+    Вернет генератор записей Photo с уникальными именами файлов.
     """
-    photos_metadata = []
-    file_name_list = []
+    file_names = UniqueFileNames()
     for media in medias:
         if media['media_type'] == 'IMAGE':
-            file_name = f"{str(media['like_count'])}.jpg"
-            if file_name in file_name_list:
-                file_name = f"{str(media['like_count'])}{str(media['timestamp'])}.jpg"
-            file_name_list.append(file_name)
-            photos_metadata.append({'album_id': 'Media', 'file_name': file_name,
-                                    'size': 'IMAGE', 'url': media['media_url']})
-    return photos_metadata
-
-
-def get_list_metadata(photos):
-    """Примет список словарей с ключами {'file_name', 'size', 'url'}.
-    Возвратит список словарей с ключами {'file_name', 'size'}.
+            likes = media['like_count']
+            yield Photo(media['id'], 'Media', file_names.take(likes, f"{likes}{media['timestamp']}"),
+                        'IMAGE', media['media_url'])
+
+
+class MetadataWriter:
+    """Журнал метаданных файлов, загруженных в папку альбома: ./file_path/metadata.jsonl.
+    Запись о каждом файле (имя, тип размера, ID фото, назначение, ID или путь файла в назначении,
+    байты, SHA-256, время передачи) дописывается сразу после его загрузки, поэтому прерванный запуск
+    ничего не теряет, а список всех фото не копится в памяти.
+    close() собирает из журнала компактный ./file_path/metadata.json: последнюю запись о каждом файле
+    в каждом назначении, в том числе из прошлых запусков. recorded - число записей за время жизни обьекта.
     """
-    metadata = []
-    for photo in photos:
-        metadata.append({'file_name': photo['file_name'], 'size': photo['size']})
-    return metadata
 
-
-def write_metadata(metadata, file_path):
-    """Примет список словарей с ключами {'file_name', 'size'} и путь к файлу с метаданными file_path.
-    Создаст json-файл с информацией по файлу по адресу file_path.
+    def __init__(self, file_path):
+        """Конструктор класса MetadataWriter.
+        Примет путь папки альбома file_path относительно текущей папки.
+        """
+        self.file_path = file_path
+        self.directory = f"{os.getcwd()}/{file_path}"
+        os.makedirs(self.directory, exist_ok=True)
+        self.journal_path = f"{self.directory}/metadata.jsonl"
+        self.recorded = 0
+        self.lock = threading.Lock()
+        self.file = open(self.journal_path, 'a', encoding='utf-8')
+        if self.file.tell() > 0:
+            with open(self.journal_path, 'rb') as journal:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def record(self, photo, destination, location=None, stream=None, seconds=None):
+        """Допишет в журнал запись о файле photo, загруженном в назначение destination по адресу location.
+        Байты и SHA-256 берутся из потока stream, если содержимое известно заранее (stream.sha256)
+        или поток прочитан до конца; если файл уже был на месте и поток не читался, они не пишутся.
+        seconds - время передачи.
+        """
+        entry = {'file_name': photo['file_name'], 'size': photo['size'], 'id': photo.get('id'),
+                 'destination': destination, 'location': location}
+        if stream is not None and stream.sha256 is not None:
+            entry['bytes'] = stream.bytes_read if stream.size is None else stream.size
+            entry['sha256'] = stream.sha256
+        elif stream is not None and stream.finished:
+            entry['bytes'] = stream.bytes_read
+            entry['sha256'] = None if stream.digest is None else stream.digest.hexdigest()
+        if seconds is not None:
+            entry['seconds'] = round(seconds, 3)
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.recorded += 1
+
+    def wrap(self, send, destination):
+        """Возвратит функцию send(photo, stream), которая после загрузки запишет метаданные файла.
+        Функция send назначения destination должна возвращать ID или путь загруженного файла.
+        """
+        def send_and_record(photo, stream):
+            if stream.sha256 is None:
+                stream.digest = hashlib.sha256()
+            started = time.perf_counter()
+            location = send(photo, stream)
+            self.record(photo, destination, location, stream, time.perf_counter() - started)
+        return send_and_record
+
+    def close(self):
+        """Закроет журнал и перепишет по нему metadata.json. Журнал читается дважды,
+        в памяти держатся только номера последних строк о каждом файле.
+        """
+        self.file.close()
+        latest = {}
+        with open(self.journal_path, 'r', encoding='utf-8') as journal:
+            for number, line in enumerate(journal):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                latest[(entry.get('destination'), entry['file_name'])] = number
+        keep = set(latest.values())
+        with open(self.journal_path, 'r', encoding='utf-8') as journal, \
+                open(f"{self.directory}/metadata.json.tmp", 'w', encoding='utf-8') as file:
+            file.write('[')
+            separator = ''
+            for number, line in enumerate(journal):
+                if number in keep:
+                    file.write(separator + line.strip())
+                    separator = ',\n'
+            file.write(']\n')
+        os.replace(f"{self.directory}/metadata.json.tmp", f"{self.directory}/metadata.json")
+        print(f"Путь к файлу с метаданными: ./{self.file_path}/metadata.json (файлов: {len(keep)})")
+        print()
+
+
+def write_near_duplicates_report(report, file_path):
+    """Примет список групп почти одинаковых фото и путь к папке альбома file_path.
+    Создаст json-файл с отчетом по адресу ./file_path/near_duplicates.json рядом с metadata.json.
     """
-    work_path = os.getcwd()
-    path_for_write = f"{work_path}/{file_path}"
+    path_for_write = f"{os.getcwd()}/{file_path}"
     if not os.path.exists(path_for_write):
         os.makedirs(path_for_write)
-    with open(f"{path_for_write}/metadata.json", "w", encoding="utf-8") as file:
-        json.dump(metadata, file)
-    print(f"Путь к файлу с метаданными: "
-          f"./{file_path}/metadata.json")
-    print(metadata)
-    print()
+    with open(f"{path_for_write}/near_duplicates.json", "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Найдено групп похожих фото: {len(report)}, отчет: ./{file_path}/near_duplicates.json")
 
 
 def input_command(commands_desc, step, nb_albums, media_choice=None):
@@ -379,7 +2854,8 @@ def input_command(commands_desc, step, nb_albums, media_choice=None):
 
 def input_token(command):
     """Возвратит токен или путь к файлу.
-    Примет выбор загрузчика: y=Яндекс Диск или g=Google Drive.
+    Примет выбор загрузчика: y=Яндекс Диск, g=Google Drive, b=оба (вернет пару значений),
+    l=локальная папка или a=архив.
     """
     if command == 'y':
         message = 'Введите токен для Яндекс Диска: '
@@ -387,33 +2863,88 @@ def input_token(command):
     elif command == 'g':
         message = 'Введите путь к service_account_file пользователя: '
         value = input(message)
+    elif command == 'l':
+        message = 'Введите путь к папке для копий: '
+        value = input(message)
+    elif command == 'a':
+        message = 'Введите путь к архиву (.tar или .zip): '
+        value = input(message)
+    elif command == 'b':
+        value = (input_token('y'), input_token('g'))
     else:
         value = 'Ошибка'
     return value
 
 
-def create_yandex_uploader(ya_token):
+def uploader_settings(dedup=False, cache_dir=CACHE_DIR, cache_bytes=CACHE_BYTES, download_workers=4,
+                      upload_workers=4, queue_size=8):
+    """Возвратит именованные аргументы конструктора, общие для всех загрузчиков.
+    Примет признак дедупликации по содержимому, каталог кеша скачанных файлов (None - без кеша),
+    допустимый обьем кеша в байтах, число параллельных скачиваний, загрузок и размер очереди между ними.
+    """
+    cache = None if cache_dir is None else MediaCache.shared(cache_dir, max_bytes=cache_bytes)
+    return {'cache': cache, 'dedup': dedup, 'download_workers': download_workers, 'upload_workers': upload_workers,
+            'queue_size': queue_size}
+
+
+def create_yandex_uploader(ya_token, resume=False, remote_fetch=False, **settings):
     """Создаст и возвратит обьект класса YandexUploader.
-    Примет токен с Полигона Яндекс Диска.
+    Примет токен с Полигона Яндекс Диска, признак продолжения прерванных загрузок,
+    признак загрузки по ссылке силами Яндекс Диска и общие настройки загрузчиков (см. uploader_settings).
     """
     # with open('ya_token.txt', 'r') as file_object:
     #     my_yandex_token = file_object.read().strip()
     # uploader = YandexUploader(my_yandex_token)
-    uploader = YandexUploader(ya_token)
+    uploader = YandexUploader(ya_token, state=BackupState(resume=resume), remote_fetch=remote_fetch,
+                              **uploader_settings(**settings))
     return uploader
 
 
-def create_google_uploader(credentials_file_name):
+def create_google_uploader(credentials_file_name, resume=False, **settings):
     """Создаст и возвратит обьект класса GoogleDriveUploader.
-    Примет путь к service_account_file пользователя Google.
+    Примет путь к service_account_file пользователя Google, признак продолжения прерванных загрузок
+    и общие настройки загрузчиков (см. uploader_settings).
     """
     # uploader = GoogleDriveUploader('credentials.json')
-    uploader = GoogleDriveUploader(credentials_file_name)
+    uploader = GoogleDriveUploader(credentials_file_name, state=BackupState(resume=resume),
+                                   **uploader_settings(**settings))
     return uploader
 
 
-def vk_create_user():
+def create_multi_uploader(tokens, resume=False, **settings):
+    """Создаст и возвратит обьект класса MultiUploader для Яндекс Диска и Google Drive.
+    Примет пару: токен Яндекс Диска и путь к service_account_file пользователя Google,
+    признак продолжения прерванных загрузок и общие настройки загрузчиков (см. uploader_settings).
+    """
+    ya_token, credentials_file_name = tokens
+    uploader = MultiUploader([create_yandex_uploader(ya_token, resume, **settings),
+                              create_google_uploader(credentials_file_name, resume, **settings)],
+                             **uploader_settings(**settings))
+    return uploader
+
+
+def create_local_uploader(directory, resume=False, **settings):
+    """Создаст и возвратит обьект класса LocalDirectoryUploader.
+    Примет путь к папке для копий (локальной или сетевой), признак продолжения прерванных загрузок
+    и общие настройки загрузчиков (см. uploader_settings).
+    """
+    return LocalDirectoryUploader(directory, state=BackupState(resume=resume), **uploader_settings(**settings))
+
+
+def create_archive_uploader(path, resume=False, **settings):
+    """Создаст и возвратит обьект класса ArchiveUploader.
+    Примет путь к архиву .tar или .zip, признак продолжения прерванных загрузок
+    и общие настройки загрузчиков (см. uploader_settings).
+    Дедупликация по содержимому в архиве не используется, настройка dedup пропускается.
+    """
+    settings = uploader_settings(**settings)
+    del settings['dedup']
+    return ArchiveUploader(path, state=BackupState(resume=resume), **settings)
+
+
+def vk_create_user(parallel_pages=False, page_workers=4):
     """Спросит ID искомого пользователя VK, создаст и возвратит обьект класса VkUser.
+    Примет признак параллельного чтения страниц альбомов и число потоков для него.
     Необходим рабочий токен пользователя VK API в файле vk_token.txt корневого каталога.
     """
     with open('vk_token.txt', 'r') as file_object:
@@ -422,7 +2953,7 @@ def vk_create_user():
     while True:
         target_id = input('Введите ID пользователя VK: ')
         if vk.targetUserExists(target_id):
-            return VkUser(my_vk_token, '5.130', target_id)
+            return VkUser(my_vk_token, '5.130', target_id, parallel_pages, page_workers)
 
 
 def ig_create_user():
@@ -438,30 +2969,130 @@ def ig_create_user():
             return InstaUser(my_instagram_token, 'v10.0', target_ig_username)
 
 
-def vk_upload_album(uploader, media, album_id, album_name=None):
-    """Загрузит альбом пользователя VK.
-    Примет обьект класса загрузки, обьект класса VKUser, id альбома, название альбома.
-    """
-    photos = vk_get_list_for_load(media.getPhotos(media.target_id, album_id))
-    if len(photos) == 0:
-        print(f"В альбоме нет доступных фото.\n")
-    elif len(photos) > uploader.max_number_photos:
-        uploader.upload(photos, media.class_name, media.target_name, album_name,
-                        input_number_for_download(album_id if album_name is None else album_name, len(photos)))
-    else:
-        uploader.upload(photos, media.class_name, media.target_name, album_name)
-
+class AlbumScheduler:
+    """Параллельная загрузка нескольких альбомов одним загрузчиком.
+    Одновременно выполняется не больше album_workers альбомов, а их конвейеры делят общий бюджет
+    одновременных передач фото, поэтому небольшие альбомы не ждут окончания большого.
+    Крупные альбомы запускаются первыми, чтобы не задерживать завершение всей загрузки.
+    """
 
-def vk_upload_all_albums(uploader, media):
-    """Загрузит все альбомы пользователя VK.
-    Примет обьект класса загрузки и обьект класса VKUser.
+    def __init__(self, uploader, album_workers=3, transfer_budget=None):
+        """Конструктор класса AlbumScheduler.
+        Примет обьект класса загрузки, число одновременно загружаемых альбомов
+        и общий предел одновременных передач фото (по умолчанию - как у одного конвейера загрузчика).
+        """
+        self.uploader = uploader
+        self.album_workers = max(1, album_workers)
+        pipeline = uploader.pipeline
+        if transfer_budget is None:
+            transfer_budget = pipeline.download_workers + pipeline.queue_size + pipeline.upload_workers
+        if pipeline.budget is None:
+            pipeline.budget = threading.BoundedSemaphore(transfer_budget)
+        http_sessions.resize(transfer_budget + self.album_workers * pipeline.upload_workers)
+
+    def run(self, jobs, upload_album):
+        """Примет список заданий альбомов с ключами {'name', 'count', ...} и функцию upload_album(job).
+        Загрузит альбомы параллельно. Ошибка одного альбома не прерывает остальные,
+        ошибки печатаются после завершения. Возвратит список пар (задание, ошибка).
+        """
+        failures = []
+        jobs = sorted(jobs, key=lambda job: job['count'], reverse=True)
+        with ThreadPoolExecutor(self.album_workers) as executor:
+            futures = [(job, executor.submit(upload_album, job)) for job in jobs]
+            for job, future in futures:
+                error = future.exception()
+                if error is not None:
+                    failures.append((job, error))
+        for job, error in failures:
+            print(f"Альбом {job['name']} не загружен: {error}")
+        return failures
+
+
+def vk_plan_album(uploader, media, album_id, album_name=None, items=None, limit=None, ask=None, first_page=None):
+    """Подготовит задание загрузки альбома пользователя VK и заранее спросит, сколько фото загрузить.
+    Примет обьект класса загрузки, обьект класса VKUser, id альбома, название альбома,
+    если они уже получены, список обьектов фотографий альбома, заданный предел числа фото limit,
+    функцию ask(album_name, photos_count), которая спросит число фото, если limit не задан
+    (по умолчанию input_number_for_download), и уже полученную первую страницу альбома.
+    Возвратит словарь задания или None, если в альбоме нет доступных фото.
+    """
+    if items is not None:
+        photos_count = len(items)
+    elif first_page is not None:
+        photos_count = first_page['count']
+    else:
+        photos_count = media.getPhotosCount(media.target_id, album_id)
+    name = album_id if album_name is None else album_name
+    if photos_count == 0:
+        print(f"В альбоме {name} нет доступных фото.\n")
+        return None
+    number_photos = None
+    if limit is not None:
+        number_photos = min(limit, photos_count)
+    elif photos_count > uploader.max_number_photos:
+        number_photos = (ask or input_number_for_download)(name, photos_count)
+    return {'album_id': album_id, 'album_name': album_name, 'name': name, 'items': items, 'first_page': first_page,
+            'count': min(photos_count, uploader.max_number_photos if number_photos is None else number_photos),
+            'number_photos': number_photos}
+
+
+def vk_run_album(uploader, media, job):
+    """Загрузит альбом пользователя VK по заданию, подготовленному vk_plan_album.
+    Если список фото не получен заранее, страницы альбома читаются по ходу загрузки.
+    Число загруженных и пропущенных фото запишет в задание ('uploaded', 'skipped')."""
+    items = job['items']
+    if items is None:
+        items = media.iterPhotos(media.target_id, job['album_id'], first_page=job['first_page'])
+    photos = vk_get_list_for_load(items)
+    job.update(uploader.upload(photos, media.class_name, media.target_name, job['album_name'], job['number_photos']))
+
+
+def vk_upload_album(uploader, media, album_id, album_name=None, items=None):
+    """Загрузит альбом пользователя VK.
+    Примет обьект класса загрузки, обьект класса VKUser, id альбома, название альбома
+    и, если они уже получены, список обьектов фотографий альбома.
+    """
+    job = vk_plan_album(uploader, media, album_id, album_name, items)
+    if job is not None:
+        vk_run_album(uploader, media, job)
+
+
+def vk_upload_albums(uploader, media, selection=None, limit=None, limits=None, album_workers=3, ask=None):
+    """Загрузит выбранные альбомы пользователя VK.
+    Примет обьект класса загрузки, обьект класса VKUser, список альбомов selection (ID, названия,
+    'profile', 'wall'; None или 'all' - все альбомы), общий предел числа фото limit, пределы по альбомам
+    limits {ID или название: число}, число одновременно загружаемых альбомов и функцию ask для вопроса
+    о числе фото (см. vk_plan_album).
+    Сначала соберет все альбомы, их первые страницы и ответы на вопросы о количестве фото,
+    затем загрузит альбомы параллельно, дочитывая остальные страницы каждого альбома по ходу загрузки.
+    Возвратит список заданий альбомов и список пар (задание, ошибка) для незагруженных альбомов.
     """
-    vk_upload_profile_photos(uploader, media)
-    vk_upload_wall_photos(uploader, media)
     album_list = media.getAlbumsInfo(media.target_id)
-    if len(album_list) != 0:
-        for album in album_list:
-            vk_upload_album(uploader, media, album['id'], album['title'])
+    albums = [('profile', None), ('wall', 'wall')] + [(album['id'], album['title']) for album in album_list]
+    if selection is not None and 'all' not in selection:
+        wanted = {str(name) for name in selection}
+        albums = [(album_id, album_name) for album_id, album_name in albums
+                  if str(album_id) in wanted or album_name in wanted]
+        missing = wanted - {str(album_id) for album_id, _ in albums} - {album_name for _, album_name in albums}
+        if missing:
+            raise ValueError(f"Альбомы не найдены: {', '.join(sorted(missing))}")
+    limits = limits or {}
+    first_pages = media.getAlbumsFirstPages(media.target_id, [album_id for album_id, _ in albums])
+    uploader.prepareFolders(media.class_name, media.target_name,
+                            [album_name for _, album_name in albums if album_name is not None])
+    jobs = [vk_plan_album(uploader, media, album_id, album_name, first_page=first_pages[album_id],
+                          limit=limits.get(album_name, limits.get(str(album_id), limit)), ask=ask)
+            for album_id, album_name in albums]
+    jobs = [job for job in jobs if job is not None]
+    failures = AlbumScheduler(uploader, album_workers).run(jobs, partial(vk_run_album, uploader, media))
+    return jobs, failures
+
+
+def vk_upload_all_albums(uploader, media, album_workers=3):
+    """Загрузит все альбомы пользователя VK.
+    Примет обьект класса загрузки, обьект класса VKUser и число одновременно загружаемых альбомов.
+    """
+    vk_upload_albums(uploader, media, album_workers=album_workers)
 
 
 def vk_upload_wall_photos(uploader, media):
@@ -531,38 +3162,247 @@ def get_media_count(media_profile):
         return media_profile.target_media_count
 
 
-def ig_upload_all_photos(uploader, media):
+def ig_upload_all_photos(uploader, media, limit=None, ask=None):
     """Вызовет методы загрузки всех доступных медиафайлов пользователя Instagram.
-    Примет обьект класса загрузки и обьект класса InstaUser.
+    Примет обьект класса загрузки, обьект класса InstaUser, предел числа фото limit
+    и функцию ask(album_name, photos_count), которая спросит число фото, если limit не задан.
+    Возвратит словарь {'uploaded', 'skipped'} с числом загруженных и пропущенных фото (см. upload).
     """
     ig_upload_profile_photo(uploader, media)
-    photos = ig_get_list_for_load(media.getPhotos())
-    if len(photos) == 0:
+    photos = ig_get_list_for_load(media.iterPhotos())
+    first_photo = next(photos, None)
+    if first_photo is None:
         print(f"Нет доступных фото.\n")
-    elif len(photos) > uploader.max_number_photos:
-        uploader.upload(photos, media.class_name, media.target_name, 'Media',
-                        input_number_for_download('Media', len(photos)))
-    else:
-        uploader.upload(photos, media.class_name, media.target_name, 'Media')
+        return {'uploaded': 0, 'skipped': 0}
+    number_photos = None
+    if limit is not None:
+        number_photos = min(limit, media.target_media_count)
+    elif media.target_media_count > uploader.max_number_photos:
+        number_photos = (ask or input_number_for_download)('Media', media.target_media_count)
+    return uploader.upload(chain([first_photo], photos), media.class_name, media.target_name, 'Media', number_photos)
 
 
 def ig_upload_profile_photo(uploader, media):
     """Вызовет метод загрузки фотографии профиля пользователя Instagram.
     Примет обьект класса загрузки и обьект класса InstaUser.
     """
-    photo = [{'album_id': 'profile', 'file_name': 'profile_photo', 'size': 'profile',
-              'url': f"{media.profile_picture_url}"}]
+    photo = [Photo('profile', 'profile', 'profile_photo', 'profile', f"{media.profile_picture_url}")]
     uploader.upload(photo, media.class_name, media.target_name)
 
 
-def main():
+def take_all(album_name, photos_count):
+    """Ответ на вопрос о числе фото для загрузки без диалога: все доступные фото."""
+    return photos_count
+
+
+def read_secret(config, name, default_file):
+    """Возвратит секрет name из словаря config: значение ключа name
+    или содержимое файла из ключа f"{name}_file" (по умолчанию default_file).
+    """
+    if config.get(name):
+        return config[name]
+    with open(config.get(f"{name}_file", default_file), 'r') as file_object:
+        return file_object.read().strip()
+
+
+def load_job_file(path):
+    """Прочитает файл заданий JSON или YAML (по расширению .yaml или .yml) и возвратит словарь настроек.
+    Если в файле только список заданий, он станет значением ключа 'jobs'.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError('Для файлов заданий YAML нужен пакет PyYAML') from None
+            config = yaml.safe_load(file)
+        else:
+            config = json.load(file)
+    if isinstance(config, list):
+        config = {'jobs': config}
+    return config
+
+
+class BatchRunner:
+    """Резервное копирование многих аккаунтов VK и Instagram по файлу заданий, без диалога.
+    Загрузчики и API-клиенты создаются один раз на все задания, аккаунты обрабатываются параллельно
+    не более чем в workers потоков, а конвейеры всех загрузчиков делят общий бюджет передач.
+
+    Файл заданий: {'workers', 'album_workers', 'transfers', 'download_workers', 'upload_workers', 'queue_size',
+    'target', 'dedup',
+    'cache': {'directory', 'max_mb'} или false (без кеша скачанных файлов),
+    'targets': {'yandex': {'token' или 'token_file', 'remote_fetch'}, 'gdrive': {'credentials'}, 'local': {'path'},
+                'archive': {'path'}},
+    'vk': {'token' или 'token_file', 'version', 'parallel_pages', 'page_workers'},
+    'instagram': {'token' или 'token_file', 'version'},
+    'near_duplicates': {параметры NearDuplicateDetector},
+    'jobs': [{'source': 'vk' или 'instagram', 'account', 'target': 'yandex', 'gdrive', 'both', 'local' или 'archive',
+              'albums' (список или одно название/ID альбома), 'limit', 'limits'}]}.
+    """
+
+    def __init__(self, config, workers=None, resume=False, settings=None, parallel_pages=False, page_workers=None):
+        """Конструктор класса BatchRunner.
+        Примет словарь настроек из файла заданий, число параллельно обрабатываемых аккаунтов
+        (по умолчанию из настроек или 4), признак продолжения прерванных загрузок,
+        общие настройки загрузчиков из командной строки (см. uploader_settings),
+        которые заменяют одноименные настройки файла заданий, признак параллельного чтения страниц
+        альбомов VK и число потоков для него (по умолчанию из настроек 'vk' или 4).
+        """
+        self.config = config
+        self.workers = workers or config.get('workers', 4)
+        self.resume = resume
+        self.parallel_pages = parallel_pages or config.get('vk', {}).get('parallel_pages', False)
+        self.page_workers = page_workers or config.get('vk', {}).get('page_workers', 4)
+        self.settings = self.uploaderSettings(config)
+        self.settings.update(settings or {})
+        self.album_workers = config.get('album_workers', 2)
+        self.budget = threading.BoundedSemaphore(config.get('transfers', 16))
+        self.uploaders = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def uploaderSettings(config):
+        """Возвратит общие настройки загрузчиков (см. uploader_settings) из словаря настроек файла заданий."""
+        settings = {'dedup': config.get('dedup', False)}
+        for name in ('download_workers', 'upload_workers', 'queue_size'):
+            if name in config:
+                settings[name] = config[name]
+        cache = config.get('cache', {})
+        if cache is False:
+            settings['cache_dir'] = None
+        else:
+            if 'directory' in cache:
+                settings['cache_dir'] = cache['directory']
+            if 'max_mb' in cache:
+                settings['cache_bytes'] = cache['max_mb'] * 1024 ** 2
+        return settings
+
+    def createUploader(self, target):
+        """Создаст загрузчик для назначения target: 'yandex', 'gdrive', 'both', 'local' или 'archive'."""
+        targets = self.config.get('targets', {})
+        if target == 'yandex':
+            return create_yandex_uploader(read_secret(targets.get('yandex', {}), 'token', 'ya_token.txt'), self.resume,
+                                          targets.get('yandex', {}).get('remote_fetch', False), **self.settings)
+        if target == 'gdrive':
+            return create_google_uploader(targets.get('gdrive', {}).get('credentials', 'credentials.json'),
+                                          self.resume, **self.settings)
+        if target == 'both':
+            return create_multi_uploader((read_secret(targets.get('yandex', {}), 'token', 'ya_token.txt'),
+                                          targets.get('gdrive', {}).get('credentials', 'credentials.json')),
+                                         self.resume, **self.settings)
+        if target == 'local':
+            return create_local_uploader(targets.get('local', {}).get('path', 'backup'), self.resume, **self.settings)
+        if target == 'archive':
+            return create_archive_uploader(targets.get('archive', {}).get('path', 'backup.tar'), self.resume,
+                                           **self.settings)
+        raise ValueError(f"Неизвестное назначение: {target}")
+
+    def getUploader(self, target):
+        """Возвратит общий для всех заданий загрузчик назначения target, создав его при первом обращении."""
+        with self.lock:
+            if target not in self.uploaders:
+                uploader = self.createUploader(target)
+                uploader.pipeline.budget = self.budget
+                if self.config.get('near_duplicates'):
+                    uploader.near_duplicates = NearDuplicateDetector(**self.config['near_duplicates'])
+                self.uploaders[target] = uploader
+            return self.uploaders[target]
+
+    def getClient(self, source):
+        """Возвратит общий для всех заданий API-клиент источника source: 'vk' или 'instagram'."""
+        with self.lock:
+            if source not in self.clients:
+                settings = self.config.get(source, {})
+                if source == 'vk':
+                    token = read_secret(settings, 'token', 'vk_token.txt')
+                    self.clients[source] = Vk(token, settings.get('version', '5.130'))
+                elif source == 'instagram':
+                    token = read_secret(settings, 'token', 'instagram_token.txt')
+                    self.clients[source] = Insta(token, settings.get('version', 'v10.0'))
+                else:
+                    raise ValueError(f"Неизвестный источник: {source}")
+            return self.clients[source]
+
+    def runJob(self, job):
+        """Выполнит одно задание и возвратит словарь с его итогом для отчета."""
+        started = time.monotonic()
+        source = job.get('source', 'vk')
+        target = job.get('target', self.config.get('target', 'yandex'))
+        result = {'source': source, 'account': str(job.get('account')), 'target': target,
+                  'status': 'ok', 'albums': []}
+        try:
+            uploader = self.getUploader(target)
+            client = self.getClient(source)
+            if not client.targetUserExists(job['account']):
+                raise ValueError(f"Нет доступа к аккаунту {job['account']}")
+            if source == 'vk':
+                media = VkUser(client.token, client.version, job['account'], self.parallel_pages,
+                               self.page_workers)
+                selection = job.get('albums')
+                if isinstance(selection, (str, int)):
+                    selection = [selection]
+                jobs, failures = vk_upload_albums(uploader, media, selection, job.get('limit'),
+                                                  job.get('limits'), self.album_workers, take_all)
+                errors = {id(album): error for album, error in failures}
+                for album in jobs:
+                    error = errors.get(id(album))
+                    if error is None:
+                        status = 'ok'
+                    else:
+                        status = 'partial' if isinstance(error, PartialUploadError) else 'failed'
+                    result['albums'].append({'name': str(album['name']), 'planned': album['count'],
+                                             'uploaded': album.get('uploaded'), 'skipped': album.get('skipped'),
+                                             'status': status, 'error': None if error is None else str(error)})
+                if failures:
+                    result['status'] = 'partial'
+            else:
+                media = InstaUser(client.access_token, job.get('version', self.config.get(source, {})
+                                                               .get('version', 'v10.0')),
+                                  job['account'], client=client)
+                try:
+                    counts = ig_upload_all_photos(uploader, media, job.get('limit'), take_all)
+                    result['albums'].append({'name': 'Media', 'uploaded': counts['uploaded'],
+                                             'skipped': counts['skipped'], 'status': 'ok', 'error': None})
+                except PartialUploadError as error:
+                    result['status'] = 'partial'
+                    result['albums'].append({'name': 'Media', 'uploaded': None, 'skipped': None, 'status': 'partial',
+                                             'error': str(error)})
+        except Exception as error:
+            result['status'] = 'failed'
+            result['error'] = str(error)
+        result['seconds'] = round(time.monotonic() - started, 2)
+        return result
+
+    def run(self):
+        """Выполнит все задания и возвратит сводку: итоги заданий и число успешных, частичных и неудачных."""
+        jobs = self.config.get('jobs', [])
+        try:
+            with ThreadPoolExecutor(max(1, self.workers)) as executor:
+                results = list(executor.map(self.runJob, jobs))
+        finally:
+            for uploader in self.uploaders.values():
+                uploader.close()
+        summary = {'jobs': results}
+        for status in ('ok', 'partial', 'failed'):
+            summary[status] = sum(result['status'] == status for result in results)
+        return summary
+
+
+def main(resume=False, parallel_pages=False, page_workers=4, **settings):
     storage = {'commands': {'y': create_yandex_uploader,
-                            'g': create_google_uploader},
+                            'g': create_google_uploader,
+                            'b': create_multi_uploader,
+                            'l': create_local_uploader,
+                            'a': create_archive_uploader},
                'description': {'y': 'Yandex Disc',
                                'g': 'Google Drive',
+                               'b': 'Yandex Disc + Google Drive',
+                               'l': 'Local folder / NAS',
+                               'a': 'Archive (tar/zip)',
                                'q': 'quit'}}
 
-    media = {'commands': {'v': vk_create_user,
+    media = {'commands': {'v': partial(vk_create_user, parallel_pages, page_workers),
                           'i': ig_create_user},
              'description': {'v': 'VKontakte',
                              'i': 'Instagram',
@@ -588,27 +3428,116 @@ def main():
         user_storage_choice = input_command(storage['description'], 1, 0)
         if user_storage_choice != 'q':
             user_token = input_token(user_storage_choice)
-            while True:
-                user_media_choice = input_command(media['description'], 2, 0)
-                if user_media_choice != 'q':
-                    uploader_profile = storage['commands'][user_storage_choice](user_token)
-                    media_profile = media['commands'][user_media_choice]()
-                    print(f"\nПрофиль: {media_profile.target_name} ({media_profile.class_name})"
-                          f" ==> Профиль: {uploader_profile.name} ({uploader_profile.class_name})")
-                    while True:
-                        user_album_choice = \
-                            input_command(albums['description'][user_media_choice], 3,
-                                          get_media_count(media_profile), user_media_choice)
-                        if user_album_choice != 'q':
-                            albums['commands'][user_media_choice][user_album_choice](uploader_profile, media_profile)
-                        else:
-                            break
-                else:
-                    break
+            uploader_profile = None
+            try:
+                while True:
+                    user_media_choice = input_command(media['description'], 2, 0)
+                    if user_media_choice != 'q':
+                        if uploader_profile is None:
+                            uploader_profile = storage['commands'][user_storage_choice](user_token, resume,
+                                                                                       **settings)
+                        media_profile = media['commands'][user_media_choice]()
+                        print(f"\nПрофиль: {media_profile.target_name} ({media_profile.class_name})"
+                              f" ==> Профиль: {uploader_profile.name} ({uploader_profile.class_name})")
+                        while True:
+                            user_album_choice = \
+                                input_command(albums['description'][user_media_choice], 3,
+                                              get_media_count(media_profile), user_media_choice)
+                            if user_album_choice != 'q':
+                                try:
+                                    albums['commands'][user_media_choice][user_album_choice](uploader_profile,
+                                                                                             media_profile)
+                                except PartialUploadError as error:
+                                    print(error)
+                            else:
+                                break
+                    else:
+                        break
+            finally:
+                if uploader_profile is not None:
+                    uploader_profile.close()
         else:
             print('До свидания!')
             break
 
 
+def parse_arguments(argv=None):
+    """Разберет аргументы командной строки argv (по умолчанию sys.argv) и возвратит их."""
+    parser = argparse.ArgumentParser(description='Резервное копирование фото из VK и Instagram '
+                                                 'на Яндекс Диск, Google Drive, в локальную папку или архив')
+    parser.add_argument('--job', help='файл заданий JSON или YAML для запуска без диалога')
+    parser.add_argument('--workers', type=int, help='сколько аккаунтов обрабатывать параллельно')
+    parser.add_argument('--summary', default='backup_summary.json',
+                        help='файл для итоговой сводки JSON ("-" - вывести в stdout)')
+    parser.add_argument('--resume', action='store_true',
+                        help='продолжить прерванные загрузки Google Drive по журналу с последнего принятого куска')
+    parser.add_argument('--dedup', action='store_true',
+                        help='не загружать повторно одинаковые по содержимому фото (каждое фото сначала '
+                             'скачивается целиком для подсчета SHA-256)')
+    parser.add_argument('--download-workers', type=int, help='сколько фото скачивать параллельно (по умолчанию 4)')
+    parser.add_argument('--upload-workers', type=int, help='сколько фото загружать параллельно (по умолчанию 4)')
+    parser.add_argument('--queue-size', type=int,
+                        help='сколько скачанных фото может ждать загрузки (по умолчанию 8)')
+    parser.add_argument('--parallel-pages', action='store_true',
+                        help='читать страницы больших альбомов VK параллельно')
+    parser.add_argument('--page-workers', type=int,
+                        help='сколько страниц альбома VK читать параллельно (по умолчанию 4)')
+    parser.add_argument('--cache-dir', help=f"каталог кеша скачанных фото (по умолчанию {CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, help=f"допустимый обьем кеша скачанных фото в Мб "
+                                                       f"(по умолчанию {CACHE_BYTES // 1024 ** 2})")
+    parser.add_argument('--no-cache', action='store_true', help='не сохранять скачанные фото в кеш')
+    parser.add_argument('--metrics', help='файл для отчета о запросах и этапах загрузки в JSON')
+    parser.add_argument('--prometheus', help='файл для тех же метрик в текстовом формате Prometheus')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """Разберет аргументы командной строки. Без файла заданий запустит диалог main(),
+    с файлом заданий - резервное копирование без диалога и запишет сводку в JSON.
+    """
+    arguments = parse_arguments(argv)
+    metrics.enabled = bool(arguments.metrics or arguments.prometheus)
+    try:
+        if arguments.job is None:
+            main(arguments.resume, arguments.parallel_pages, arguments.page_workers or 4,
+                 **settings_from_arguments(arguments))
+            return 0
+        return run_job_file(arguments)
+    finally:
+        if metrics.enabled:
+            metrics.write(arguments.metrics, arguments.prometheus)
+
+
+def settings_from_arguments(arguments):
+    """Возвратит общие настройки загрузчиков (см. uploader_settings), заданные в аргументах командной строки."""
+    settings = {}
+    if arguments.dedup:
+        settings['dedup'] = True
+    if arguments.no_cache:
+        settings['cache_dir'] = None
+    elif arguments.cache_dir is not None:
+        settings['cache_dir'] = arguments.cache_dir
+    if arguments.cache_size is not None:
+        settings['cache_bytes'] = arguments.cache_size * 1024 ** 2
+    for name in ('download_workers', 'upload_workers', 'queue_size'):
+        if getattr(arguments, name) is not None:
+            settings[name] = getattr(arguments, name)
+    return settings
+
+
+def run_job_file(arguments):
+    """Выполнит файл заданий из аргументов командной строки, запишет сводку и возвратит код завершения."""
+    summary = BatchRunner(load_job_file(arguments.job), arguments.workers, arguments.resume,
+                          settings_from_arguments(arguments), arguments.parallel_pages, arguments.page_workers).run()
+    if arguments.summary == '-':
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        with open(arguments.summary, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+        print(f"Сводка: успешно {summary['ok']}, частично {summary['partial']}, с ошибкой {summary['failed']}. "
+              f"Файл: {arguments.summary}")
+    return 0 if summary['failed'] == 0 and summary['partial'] == 0 else 1
+
+
 if __name__ == "__main__":
-    main()
+    raise SystemExit(cli())
@@ -0,0 +1,33 @@
+import json
+
+import main
+
+
+class FakeResponse:
+    """Ответ requests с содержимым data, которое отдается кусками по piece байт."""
+
+    def __init__(self, data, piece=3):
+        self.data = data
+        self.piece = piece
+        self.headers = {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        return iter([self.data[i:i + self.piece] for i in range(0, len(self.data), self.piece)])
+
+    def close(self):
+        self.closed = True
+
+
+def make_stream(data, piece=3):
+    return main.MediaStream(FakeResponse(data, piece))
+
+
+def make_photos(number):
+    return [{'file_name': f"{i}.jpg", 'size': 'z', 'id': str(i), 'url': f"http://cdn/{i}.jpg"} for i in range(number)]
+
+
+def read_metadata(path):
+    """Прочитает metadata.json папки path в словарь {(назначение, имя файла): запись}."""
+    with open(path / 'metadata.json', encoding='utf-8') as file:
+        return {(entry['destination'], entry['file_name']): entry for entry in json.load(file)}
@@ -0,0 +1,33 @@
+import pytest
+
+import main
+
+
+class FakeClient:
+    token, version = 'token', '5.131'
+
+    def targetUserExists(self, target_id):
+        return True
+
+
+class FakeVkUser:
+    def __init__(self, *arguments):
+        pass
+
+
+@pytest.mark.parametrize('albums, expected', [('profile', ['profile']), (123, [123]), (['wall', 5], ['wall', 5]),
+                                              (None, None)])
+def test_run_job_accepts_single_album(albums, expected, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    selections = []
+
+    def vk_upload_albums(uploader, media, selection, *arguments):
+        selections.append(selection)
+        return [], []
+
+    monkeypatch.setattr(main, 'VkUser', FakeVkUser)
+    monkeypatch.setattr(main, 'vk_upload_albums', vk_upload_albums)
+    runner = main.BatchRunner({'target': 'local', 'cache': False, 'targets': {'local': {'path': 'backup'}}})
+    monkeypatch.setattr(runner, 'getClient', lambda source: FakeClient())
+    assert runner.runJob({'account': '1', 'albums': albums})['status'] == 'ok'
+    assert selections == [expected]
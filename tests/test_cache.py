@@ -0,0 +1,93 @@
+import atexit
+import os
+
+import main
+from support import make_photos
+
+
+def make_cache(directory, max_bytes):
+    cache = main.MediaCache(str(directory), max_bytes=max_bytes)
+    atexit.unregister(cache.printReport)
+    return cache
+
+
+def put(cache, photo, data):
+    assert b''.join(cache.writeThrough(photo, [data[:2], data[2:]])) == data
+
+
+def read(cache, photo):
+    stream = cache.open(photo)
+    if stream is None:
+        return None
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    first, second, third = make_photos(3)
+    cache = make_cache(tmp_path, 10)
+    put(cache, first, b'aaaa')
+    put(cache, second, b'bbbb')
+    assert read(cache, first) == b'aaaa'
+    put(cache, third, b'cccc')
+    assert cache.total_bytes == 8
+    assert read(cache, second) is None
+    assert read(cache, first) == b'aaaa'
+    assert read(cache, third) == b'cccc'
+    assert len(os.listdir(tmp_path)) == 2
+
+    cache = make_cache(tmp_path, 10)
+    assert cache.total_bytes == 8
+    assert read(cache, third) == b'cccc'
+    os.utime(cache.path(cache.key(first), cache.entries[cache.key(first)][0]), (1, 1))
+    cache = make_cache(tmp_path, 4)
+    assert list(cache.entries) == [cache.key(third)]
+
+
+def test_cache_discards_corrupt_entry(tmp_path):
+    photo = make_photos(1)[0]
+    cache = make_cache(tmp_path, 100)
+    put(cache, photo, b'abcdef')
+    path = cache.path(cache.key(photo), cache.entries[cache.key(photo)][0])
+    with open(path, 'r+b') as file:
+        file.write(b'x')
+    assert read(cache, photo) is None
+    assert not os.path.exists(path)
+    assert cache.total_bytes == 0
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_cache_keeps_only_complete_streams(tmp_path):
+    photo = make_photos(1)[0]
+    cache = make_cache(tmp_path, 100)
+    chunks = cache.writeThrough(photo, [b'ab', b'cd'])
+    assert next(chunks) == b'ab'
+    chunks.close()
+    assert read(cache, photo) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_cache_key_ignores_url_signature(tmp_path):
+    photo = dict(make_photos(1)[0], url='http://cdn/0.jpg?sign=a')
+    cache = make_cache(tmp_path, 100)
+    put(cache, photo, b'abc')
+    assert read(cache, dict(photo, url='http://cdn/0.jpg?sign=b')) == b'abc'
+    assert read(cache, dict(photo, url='http://cdn/0_v2.jpg')) is None
+
+
+def test_cache_settings_reach_uploaders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {'targets': {'local': {'path': 'backup'}}, 'cache': {'directory': 'job_cache', 'max_mb': 2}}
+    uploader = main.BatchRunner(config).createUploader('local')
+    assert uploader.cache is main.MediaCache.shared('job_cache')
+    assert uploader.cache.max_bytes == 2 * 1024 ** 2
+    atexit.unregister(uploader.cache.printReport)
+    assert main.BatchRunner(dict(config, cache=False)).createUploader('local').cache is None
+
+    arguments = main.parse_arguments(['--job', 'jobs.json', '--cache-dir', 'cli_cache', '--cache-size', '3'])
+    settings = main.BatchRunner(config, settings=main.settings_from_arguments(arguments)).settings
+    assert (settings['cache_dir'], settings['cache_bytes']) == ('cli_cache', 3 * 1024 ** 2)
+    assert main.settings_from_arguments(main.parse_arguments(['--no-cache'])) == {'cache_dir': None}
+    assert main.settings_from_arguments(main.parse_arguments([])) == {}
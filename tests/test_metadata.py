@@ -0,0 +1,40 @@
+import main
+from support import make_photos, make_stream, read_metadata
+
+
+def test_metadata_close_keeps_latest_record(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    photo, other = make_photos(2)
+    writer = main.MetadataWriter('VKontakte/user/album')
+    writer.record(photo, 'yandex', 'old')
+    writer.record(photo, 'gdrive', 'id1')
+    writer.record(other, 'yandex', 'path2')
+    writer.record(photo, 'yandex', 'new')
+    writer.close()
+    entries = read_metadata(tmp_path / 'VKontakte/user/album')
+    assert len(entries) == 3
+    assert entries[('yandex', '0.jpg')]['location'] == 'new'
+    assert writer.recorded == 4
+
+    with open(tmp_path / 'VKontakte/user/album/metadata.jsonl', 'a', encoding='utf-8') as journal:
+        journal.write('{"file_name": "broken')
+    writer = main.MetadataWriter('VKontakte/user/album')
+    writer.record(other, 'yandex', 'path3')
+    writer.close()
+    entries = read_metadata(tmp_path / 'VKontakte/user/album')
+    assert len(entries) == 3
+    assert entries[('yandex', '1.jpg')]['location'] == 'path3'
+    assert entries[('gdrive', '0.jpg')]['location'] == 'id1'
+
+
+def test_metadata_skips_hash_of_unread_stream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    photo, other = make_photos(2)
+    writer = main.MetadataWriter('album')
+    writer.wrap(lambda photo, stream: 'skipped', 'gdrive')(photo, make_stream(b'abc'))
+    writer.wrap(lambda photo, stream: stream.read() and 'sent', 'gdrive')(other, make_stream(b'abc'))
+    writer.close()
+    entries = read_metadata(tmp_path / 'album')
+    assert 'sha256' not in entries[('gdrive', '0.jpg')]
+    assert entries[('gdrive', '1.jpg')]['bytes'] == 3
+    assert entries[('gdrive', '1.jpg')]['sha256'] == main.hashlib.sha256(b'abc').hexdigest()
@@ -0,0 +1,10 @@
+import main
+
+
+def test_metrics_reset_keeps_enabled_flag():
+    metrics = main.Metrics(enabled=True)
+    metrics.observe('GET api.vk.com/method/photos.get', 0.2, 200, bytes_received=100)
+    assert metrics.report()['endpoints']
+    metrics.reset()
+    assert metrics.enabled
+    assert not metrics.report()['endpoints'] and not metrics.report()['stages']
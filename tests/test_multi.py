@@ -0,0 +1,66 @@
+import pytest
+
+import main
+from support import make_photos, make_stream
+
+
+class FlakyDirectoryUploader(main.LocalDirectoryUploader):
+    """Локальная папка, которая не принимает фото с ID из broken."""
+
+    broken = set()
+
+    def sendPhoto(self, path, photo, stream):
+        if photo['id'] in self.broken:
+            stream.read(1)
+            raise OSError('disk full')
+        return super().sendPhoto(path, photo, stream)
+
+
+def test_multi_uploader_isolates_failed_destination(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    downloaded = []
+
+    def download_photo(photo, cache=None, dedup=False):
+        downloaded.append(photo['id'])
+        return make_stream(photo['id'].encode() * 1000)
+
+    monkeypatch.setattr(main, 'download_photo', download_photo)
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    healthy = main.LocalDirectoryUploader(str(tmp_path / 'healthy'), state=state)
+    flaky = FlakyDirectoryUploader(str(tmp_path / 'flaky'), state=state)
+    flaky.class_name = 'NAS'
+    flaky.broken = {'1'}
+    multi = main.MultiUploader([healthy, flaky], download_workers=2, upload_workers=2, queue_size=2)
+    photos = make_photos(3)
+
+    with pytest.raises(main.PartialUploadError) as raised:
+        multi.upload(photos, 'VKontakte', 'user', 'album')
+    assert list(raised.value.failures) == ['NAS']
+    assert [name for name, error in raised.value.failures['NAS']] == ['1.jpg']
+    assert sorted(path.name for path in (tmp_path / 'healthy/VKontakte/user/album').glob('*.jpg')) == \
+        ['0.jpg', '1.jpg', '2.jpg']
+    assert (tmp_path / 'healthy/VKontakte/user/album/1.jpg').read_bytes() == b'1' * 1000
+    assert sorted(path.name for path in (tmp_path / 'flaky/VKontakte/user/album').glob('*.jpg')) == \
+        ['0.jpg', '2.jpg']
+    assert sorted(downloaded) == ['0', '1', '2']
+
+    flaky.broken = set()
+    downloaded.clear()
+    assert multi.upload(photos, 'VKontakte', 'user', 'album') == {'uploaded': 1, 'skipped': 2}
+    assert downloaded == ['1']
+    assert (tmp_path / 'flaky/VKontakte/user/album/1.jpg').read_bytes() == b'1' * 1000
+
+
+def test_multi_uploader_send_reaches_every_destination(tmp_path):
+    healthy = main.LocalDirectoryUploader(str(tmp_path / 'healthy'))
+    flaky = FlakyDirectoryUploader(str(tmp_path / 'flaky'))
+    flaky.class_name = 'NAS'
+    flaky.broken = {'1'}
+    multi = main.MultiUploader([healthy, flaky])
+    path, send = multi.prepareUpload('VKontakte', 'user')
+    first, second = make_photos(2)
+    assert send(first, make_stream(b'first')) == 'VKontakte/user/0.jpg'
+    assert (tmp_path / 'flaky/VKontakte/user/0.jpg').read_bytes() == b'first'
+    with pytest.raises(main.PartialUploadError, match='NAS'):
+        send(second, make_stream(b'second'))
+    assert (tmp_path / 'healthy/VKontakte/user/1.jpg').read_bytes() == b'second'
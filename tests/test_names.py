@@ -0,0 +1,12 @@
+import main
+
+
+def test_unique_file_names():
+    names = main.UniqueFileNames()
+    assert names.take(5, '5_1600') == '5.jpg'
+    assert names.take(5, '5_1600') == '5_1600.jpg'
+    assert names.take(5, '5_1600') == '5_1600_2.jpg'
+    assert names.take(5, '5_1600') == '5_1600_3.jpg'
+    assert names.take(7, '7_1600') == '7.jpg'
+    assert names.take('5_1600_4', 'x') == '5_1600_4.jpg'
+    assert names.take(5, '5_1600') == '5_1600_5.jpg'
@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+import main
+from support import make_photos
+
+
+def test_bk_tree_matches_brute_force():
+    generator = random.Random(1)
+    values = [generator.getrandbits(16) for _ in range(300)]
+    tree = main.BKTree()
+    for index, value in enumerate(values):
+        tree.add(value, index)
+    for query in values[:20] + [generator.getrandbits(16) for _ in range(20)]:
+        expected = sorted((main.hamming(query, value), index) for index, value in enumerate(values)
+                          if main.hamming(query, value) <= 3)
+        assert sorted(tree.search(query, 3)) == expected
+
+
+def test_bk_tree_empty():
+    assert main.BKTree().search(0, 5) == []
+
+
+def test_find_groups():
+    pytest.importorskip('numpy')
+    pytest.importorskip('PIL')
+    hashes = [{'phash': 0b0000, 'dhash': 0},
+              {'phash': 0b0001, 'dhash': 1},
+              None,
+              {'phash': 0xFF00, 'dhash': 0xFF00},
+              {'phash': 0xFF01, 'dhash': 0xFF00},
+              {'phash': 0b0011, 'dhash': 0xFFFF}]
+    groups, distances = main.NearDuplicateDetector(threshold=2).findGroups(hashes)
+    assert sorted(groups) == [[0, 1], [3, 4]]
+    assert distances == {0: 1, 1: 1, 3: 1, 4: 1}
+
+
+def test_hashes_are_reused_from_state(tmp_path):
+    pytest.importorskip('numpy')
+    pytest.importorskip('PIL')
+    import io
+    from PIL import Image
+
+    images = {}
+    for index, color in enumerate([(200, 10, 10), (10, 200, 10), (10, 10, 200)]):
+        image = Image.new('RGB', (64, 48), color)
+        image.paste((255, 255, 255), (index * 10, 0, index * 10 + 20, 24))
+        data = io.BytesIO()
+        image.save(data, 'JPEG')
+        images[str(index)] = data.getvalue()
+    images['2'] = b'not an image'
+    photos = make_photos(3)
+    reads = []
+    detector = main.NearDuplicateDetector(workers=1, batch_size=2)
+    detector.readPhoto = lambda photo, cache=None: reads.append(photo['id']) or images[photo['id']]
+    state = main.BackupState(str(tmp_path / 'state.db'))
+
+    hashes = detector.computeHashes(photos, state=state)
+    assert sorted(reads) == ['0', '1', '2']
+    assert hashes[0]['width'] == 64 and hashes[2] is None
+    reads.clear()
+    assert detector.computeHashes(photos, state=state) == hashes
+    assert reads == []
+    photos[1]['url'] = 'http://cdn/1_v2.jpg'
+    assert detector.computeHashes(photos, state=state) == hashes
+    assert reads == ['1']
+
+
+def test_hamming():
+    assert main.hamming(0, 0) == 0
+    assert main.hamming(0b1011, 0b0001) == 2
+    assert main.hamming(2 ** 64 - 1, 0) == 64
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+import main
+from support import make_photos, make_stream
+
+
+def test_pipeline_uploads_every_photo():
+    received = {}
+    lock = threading.Lock()
+
+    def upload(photo, stream):
+        data = stream.read()
+        with lock:
+            received[photo['file_name']] = data
+
+    photos = make_photos(20)
+    main.TransferPipeline(3, 3, 2).run(photos, lambda photo: make_stream(photo['id'].encode() * 10), upload, 'test')
+    assert received == {photo['file_name']: photo['id'].encode() * 10 for photo in photos}
+
+
+def test_pipeline_raises_download_error_and_releases_budget():
+    budget = threading.BoundedSemaphore(4)
+    streams = []
+
+    def download(photo):
+        if photo['id'] == '5':
+            raise OSError('cdn down')
+        stream = make_stream(b'data')
+        streams.append(stream)
+        return stream
+
+    with pytest.raises(OSError, match='cdn down'):
+        main.TransferPipeline(2, 2, 2, budget=budget).run(make_photos(50), download,
+                                                          lambda photo, stream: stream.read(), 'test')
+    assert all(stream.response.closed for stream in streams)
+    for _ in range(4):
+        assert budget.acquire(blocking=False)
+
+
+def test_pipeline_stops_after_upload_error():
+    downloaded = []
+
+    def download(photo):
+        downloaded.append(photo)
+        return make_stream(b'data')
+
+    def upload(photo, stream):
+        raise ValueError('upload failed')
+
+    with pytest.raises(ValueError, match='upload failed'):
+        main.TransferPipeline(1, 1, 1).run(make_photos(1000), download, upload, 'test')
+    assert len(downloaded) < 1000
+
+
+
+def test_worker_settings_reach_pipeline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {'targets': {'archive': {'path': 'backup.tar'}}, 'cache': False,
+              'download_workers': 6, 'upload_workers': 2, 'queue_size': 3}
+    arguments = main.parse_arguments(['--upload-workers', '5'])
+    runner = main.BatchRunner(config, settings=main.settings_from_arguments(arguments))
+    uploader = runner.createUploader('archive')
+    uploader.close()
+    pipeline = uploader.pipeline
+    assert (pipeline.download_workers, pipeline.upload_workers, pipeline.queue_size) == (6, 5, 3)
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import main
+
+
+def test_backoff_delay_retry_after_seconds():
+    scheduler = main.RequestScheduler(backoff_max=60)
+    assert scheduler.backoffDelay(0, '5') == 5
+    assert scheduler.backoffDelay(3, '2.5') == 2.5
+    assert scheduler.backoffDelay(0, '120') == 60
+
+
+def test_backoff_delay_retry_after_http_date():
+    scheduler = main.RequestScheduler(backoff_max=60)
+    future = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= scheduler.backoffDelay(0, future) <= 30
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)
+    assert scheduler.backoffDelay(0, past) == 0
+    far = format_datetime(datetime.now(timezone.utc) + timedelta(hours=1), usegmt=True)
+    assert scheduler.backoffDelay(0, far) == 60
+
+
+def test_backoff_delay_without_retry_after():
+    scheduler = main.RequestScheduler(backoff_base=0.5, backoff_max=4)
+    for attempt in range(6):
+        for retry_after in (None, '', 'soon'):
+            assert 0 <= scheduler.backoffDelay(attempt, retry_after) <= min(4, 0.5 * 2 ** attempt)
@@ -0,0 +1,48 @@
+import main
+from support import make_photos
+
+
+def test_is_done_ignores_url_signature_but_not_changes(tmp_path):
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    photo = dict(make_photos(1)[0], url='http://cdn/0.jpg?sign=a')
+    assert not state.isDone('yandex', 'album', photo)
+    state.markDone('yandex', 'album', photo)
+    assert state.isDone('yandex', 'album', photo)
+    assert state.isDone('yandex', 'album', dict(photo, url='http://cdn/0.jpg?sign=b'))
+    assert not state.isDone('yandex', 'album', dict(photo, url='http://cdn/0_v2.jpg'))
+    assert not state.isDone('yandex', 'album', dict(photo, file_name='0_1600.jpg'))
+    assert not state.isDone('yandex', 'other album', photo)
+    assert not state.isDone('gdrive', 'album', photo)
+
+
+def test_pending_skips_done_photos_across_runs(tmp_path):
+    photos = make_photos(5)
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    for photo in photos[:2]:
+        state.markDone('yandex', 'album', photo)
+    assert list(state.pending('yandex', 'album', photos)) == photos[2:]
+    state.connection.close()
+
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    assert list(state.pending('yandex', 'album', photos)) == photos[2:]
+    assert list(state.pending('gdrive', 'album', photos)) == photos
+
+
+def test_checkpoints_follow_transfer(tmp_path):
+    photo = make_photos(1)[0]
+    state = main.BackupState(str(tmp_path / 'state.db'), resume=True)
+    assert state.getCheckpoint('gdrive', 'album', photo) is None
+    assert list(state.pending('gdrive', 'album', [photo])) == [photo]
+    assert state.getCheckpoint('gdrive', 'album', photo) == ('pending', None, 0)
+    assert state.trackDownload('gdrive', 'album', lambda photo: 'stream', photo) == 'stream'
+    assert state.getCheckpoint('gdrive', 'album', photo)[0] == 'downloading'
+    state.checkpoint('gdrive', 'album', photo, 'uploading', 'https://upload/session', 4096)
+    state.connection.close()
+
+    state = main.BackupState(str(tmp_path / 'state.db'), resume=True)
+    assert list(state.pending('gdrive', 'album', [photo])) == [photo]
+    state.trackDownload('gdrive', 'album', lambda photo: None, photo)
+    assert state.getCheckpoint('gdrive', 'album', photo) == ('uploading', 'https://upload/session', 4096)
+    assert main.BackupState(str(tmp_path / 'state.db')).getCheckpoint('gdrive', 'album', photo) is None
+    state.markDone('gdrive', 'album', photo)
+    assert state.getCheckpoint('gdrive', 'album', photo) is None
@@ -0,0 +1,104 @@
+import atexit
+import tarfile
+import zipfile
+
+import pytest
+
+import main
+from support import make_photos, make_stream
+
+
+def archive_uploader(path, state):
+    uploader = main.ArchiveUploader(str(path), download_workers=1, upload_workers=1, queue_size=1, state=state)
+    atexit.unregister(uploader.close)
+    return uploader
+
+
+def test_zip_marks_done_only_after_close(tmp_path):
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    uploader = archive_uploader(tmp_path / 'photos.zip', state)
+    photo = make_photos(1)[0]
+    path, send = uploader.prepareUpload('VKontakte', 'user', 'album')
+    assert send(photo, make_stream(b'abc')) == 'VKontakte/user/album/0.jpg'
+    assert not state.isDone(uploader.destination, path, photo)
+    uploader.close()
+    assert state.isDone(uploader.destination, path, photo)
+    with zipfile.ZipFile(tmp_path / 'photos.zip') as archive:
+        assert archive.read('VKontakte/user/album/0.jpg') == b'abc'
+
+
+def test_zip_interrupted_append_is_written_again(tmp_path):
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    first, second = make_photos(2)
+    uploader = archive_uploader(tmp_path / 'photos.zip', state)
+    path, send = uploader.prepareUpload('VKontakte', 'user', 'album')
+    send(first, make_stream(b'first'))
+    uploader.close()
+
+    # Второй запуск прерывается после записи элемента, но до записи оглавления.
+    uploader = archive_uploader(tmp_path / 'photos.zip', state)
+    path, send = uploader.prepareUpload('VKontakte', 'user', 'album')
+    send(second, make_stream(b'second'))
+    uploader.archive.fp.flush()
+    crashed = (tmp_path / 'photos.zip').read_bytes()
+    archive, uploader.archive = uploader.archive, None
+    archive.close()
+    (tmp_path / 'photos.zip').write_bytes(crashed)
+    assert not state.isDone(uploader.destination, path, second)
+
+    uploader = archive_uploader(tmp_path / 'photos.zip', state)
+    assert (tmp_path / 'photos.zip.broken').exists()
+    assert not state.isDone(uploader.destination, path, first)
+    path, send = uploader.prepareUpload('VKontakte', 'user', 'album')
+    for photo in state.pending(uploader.destination, path, [first, second]):
+        send(photo, make_stream(photo['id'].encode()))
+    uploader.close()
+    with zipfile.ZipFile(tmp_path / 'photos.zip') as archive:
+        assert sorted(archive.namelist()) == ['VKontakte/user/album/0.jpg', 'VKontakte/user/album/1.jpg']
+    assert state.isDone(uploader.destination, path, first) and state.isDone(uploader.destination, path, second)
+
+
+def test_tar_marks_done_after_each_member(tmp_path):
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    uploader = archive_uploader(tmp_path / 'photos.tar', state)
+    photo = make_photos(1)[0]
+    path, send = uploader.prepareUpload('VKontakte', 'user')
+    send(photo, make_stream(b'abc'))
+    assert state.isDone(uploader.destination, path, photo)
+    uploader.close()
+    with tarfile.open(tmp_path / 'photos.tar') as archive:
+        assert archive.extractfile('VKontakte/user/0.jpg').read() == b'abc'
+
+
+def test_archive_sanitizes_member_names(tmp_path):
+    uploader = archive_uploader(tmp_path / 'photos.zip', None)
+    path, send = uploader.prepareUpload('VKontakte', 'a/b', '../x')
+    send(make_photos(1)[0], make_stream(b'abc'))
+    uploader.close()
+    with zipfile.ZipFile(tmp_path / 'photos.zip') as archive:
+        assert archive.namelist() == ['VKontakte/a_b/.._x/0.jpg']
+    with pytest.raises(ValueError):
+        uploader.prepareUpload('VKontakte', 'user', '..')
+
+
+def test_local_directory_writes_inside_root(tmp_path):
+    state = main.BackupState(str(tmp_path / 'state.db'))
+    uploader = main.LocalDirectoryUploader(str(tmp_path / 'backup'), state=state)
+    photo = make_photos(1)[0]
+    path, send = uploader.prepareUpload('VKontakte', '../user', 'a/b')
+    assert path == 'VKontakte/.._user/a_b'
+    send(photo, make_stream(b'abc'))
+    assert (tmp_path / 'backup' / path / '0.jpg').read_bytes() == b'abc'
+    assert state.isDone(uploader.destination, path, photo)
+    assert not list((tmp_path / 'backup' / path).glob('*.tmp'))
+    with pytest.raises(ValueError):
+        uploader.prepareUpload('VKontakte', 'user', '')
+
+
+def test_storage_backend_requires_folder_methods():
+    class Incomplete(main.StorageBackend):
+        def prepareFolders(self, folder, subfolder, album_names):
+            pass
+
+    with pytest.raises(TypeError, match='prepareUpload'):
+        Incomplete()
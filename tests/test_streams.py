@@ -0,0 +1,43 @@
+import pytest
+
+import main
+from support import make_stream
+
+
+def read_source(source, chunk_size):
+    """Прочитает источник так же, как возобновляемая загрузка Google Drive: кусками, спрашивая размер."""
+    data = b''
+    begin = 0
+    while True:
+        size = source.size()
+        chunk = source.getbytes(begin, chunk_size)
+        data += chunk
+        begin += len(chunk)
+        if size is not None and begin >= size:
+            return data, size
+
+
+@pytest.mark.parametrize('length', [0, 1, 3, 4, 5, 7, 8, 9, 16])
+def test_streaming_source_chunk_boundaries(length):
+    data = bytes(range(length))
+    source = main.StreamingMediaSource(make_stream(data), chunksize=4)
+    assert read_source(source, 4) == (data, length)
+
+
+def test_streaming_source_reads_one_chunk_ahead():
+    stream = make_stream(bytes(range(32)), piece=1)
+    source = main.StreamingMediaSource(stream, chunksize=4)
+    assert source.getbytes(0, 4) == bytes(range(4))
+    assert stream.bytes_read == 5
+    assert source.size() is None
+    assert stream.bytes_read <= 9
+
+
+def test_streaming_source_seek_skips_uploaded_bytes():
+    data = bytes(range(12))
+    source = main.StreamingMediaSource(make_stream(data), chunksize=4)
+    source.seek(8)
+    assert source.getbytes(8, 4) == data[8:]
+    assert source.size() == 12
+    with pytest.raises(ValueError):
+        source.getbytes(0, 4)
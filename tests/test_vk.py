@@ -0,0 +1,98 @@
+import re
+
+import pytest
+
+import main
+
+
+class FakeJson:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeVkSession:
+    """Сессия requests для VK API: ответ на каждый POST вычисляет handler по списку вызовов в коде execute."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.batches = []
+
+    def post(self, url, data):
+        calls = re.findall(r'API\.([\w.]+)\((\{.*?\})\)', data['code'])
+        self.batches.append(calls)
+        return FakeJson(self.handler(calls))
+
+
+def make_vk(handler, monkeypatch):
+    monkeypatch.setattr(main.scheduler, 'wait', lambda attempt, retry_after=None: None)
+    vk = main.Vk('token', '5.131')
+    vk.session = FakeVkSession(handler)
+    return vk
+
+
+def test_execute_batch_splits_calls_and_keeps_order(monkeypatch):
+    vk = make_vk(lambda calls: {'response': [params for method, params in calls]}, monkeypatch)
+    calls = [('photos.get', {'offset': offset}) for offset in range(60)]
+    results = vk.executeBatch(calls)
+    assert [len(batch) for batch in vk.session.batches] == [25, 25, 10]
+    assert results == [f'{{"offset": {offset}}}' for offset in range(60)]
+
+
+def test_execute_batch_pairs_errors_with_failed_calls(monkeypatch, capsys):
+    rounds = []
+
+    def handler(calls):
+        rounds.append(calls)
+        if len(rounds) == 1:
+            return {'response': [False, 'b', False, 'd'],
+                    'execute_errors': [{'error_code': 30, 'error_msg': 'private album'},
+                                       {'error_code': 6, 'error_msg': 'too many requests'}]}
+        return {'response': ['c']}
+
+    vk = make_vk(handler, monkeypatch)
+    assert vk.executeBatch([('photos.get', {'id': name}) for name in 'abcd']) == [None, 'b', 'c', 'd']
+    assert [len(calls) for calls in rounds] == [4, 1]
+    assert rounds[1][0][1] == '{"id": "c"}'
+    assert 'private album' in capsys.readouterr().out
+
+
+def test_execute_batch_gives_up_after_max_retries(monkeypatch):
+    vk = make_vk(lambda calls: {'response': [False] * len(calls),
+                                'execute_errors': [{'error_code': 6, 'error_msg': 'too many requests'}] * len(calls)},
+                 monkeypatch)
+    monkeypatch.setattr(main.scheduler, 'max_retries', 2)
+    with pytest.raises(main.VkApiError, match='3'):
+        vk.executeBatch([('photos.get', {})])
+    assert len(vk.session.batches) == 3
+
+
+def test_execute_batch_raises_when_execute_fails(monkeypatch):
+    vk = make_vk(lambda calls: {'error': {'error_code': 5, 'error_msg': 'auth failed'}}, monkeypatch)
+    with pytest.raises(main.VkApiError, match='auth failed'):
+        vk.executeBatch([('photos.get', {})])
+
+
+def test_batch_runner_passes_page_settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    created = []
+
+    class FakeClient:
+        token, version = 'token', '5.131'
+
+        def targetUserExists(self, target_id):
+            return True
+
+    def vk_user(*arguments):
+        created.append(arguments)
+        raise main.VkApiError('stop')
+
+    monkeypatch.setattr(main, 'VkUser', vk_user)
+    config = {'vk': {'parallel_pages': True, 'page_workers': 6}, 'target': 'local', 'cache': False,
+              'targets': {'local': {'path': 'backup'}}, 'jobs': [{'account': '1'}]}
+    runner = main.BatchRunner(config, page_workers=2)
+    monkeypatch.setattr(runner, 'getClient', lambda source: FakeClient())
+    assert runner.run()['failed'] == 1
+    assert created == [('token', '5.131', '1', True, 2)]